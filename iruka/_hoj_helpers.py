@@ -2,11 +2,6 @@ from collections import namedtuple
 from enum import Enum
 from pathlib import Path
 
-from colors import color
-from peewee import *
-
-from . import utils
-
 
 '''
 Some base data container types
@@ -108,9 +103,10 @@ def hoj_to_judge_desc(tabular):
     )
 
 
-def hoj_collect_testdata(arr_subtasks, basepath):
+def hoj_collect_testdata(arr_subtasks, basepath, manifest=None):
     '''
-    Check whether all testdata paths are valid.
+    Check whether all testdata paths are valid. With a `manifest` of basepath,
+    it is looked up instead of the filesystem.
     '''
     exts = ('in', 'out')
     testdata = []
@@ -122,7 +118,10 @@ def hoj_collect_testdata(arr_subtasks, basepath):
         testdata_paths = tuple((base / '{}.{}'.format(task.label, ext)) for ext in exts)
 
         for p in testdata_paths:
-            if not p.is_file():
+            if manifest is not None:
+                if p.name not in manifest:
+                    missing_files.append(p)
+            elif not p.is_file():
                 missing_files.append(p)
 
         testdata.append(testdata_paths)
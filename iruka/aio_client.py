@@ -0,0 +1,236 @@
+'''A client built on grpc.aio, serving the Listen stream, heartbeats and the
+reports of all judge slots concurrently on a single channel.
+
+Judging itself is blocking, so each slot runs its pipeline in an executor of
+its own and the events are relayed to the ReportSubmission stream as they are
+produced.
+'''
+
+import asyncio
+import contextlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+import grpc.aio
+from google.protobuf import empty_pb2
+
+import iruka.handlers
+from iruka import metrics
+from iruka.cli import IrukaClient
+from iruka.common.utils import pformat_pb
+from iruka.protos import (iruka_rpc_pb2, iruka_rpc_pb2_grpc)
+from iruka.utils.backoff import Backoff
+
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class AsyncIrukaClient(IrukaClient):
+    def __init__(self, config):
+        super().__init__(config)
+        # submission ids being judged, by slot index
+        self.judging = {}
+        self.executors = {
+            slot.index: ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='slot{}'.format(slot.index))
+            for slot in self.slots}
+
+    def connect(self):
+        return asyncio.run(self.connectAsync())
+
+    async def connectAsync(self):
+        logger.debug('Connecting to {}...'.format(self.config.server))
+        target, creds, options = self.channelArgs()
+        if creds is not None:
+            channel = grpc.aio.secure_channel(target, creds, options)
+        else:
+            channel = grpc.aio.insecure_channel(target, options)
+
+        backoff = Backoff(
+            self.config.reconnect_backoff_min, self.config.reconnect_backoff_max)
+        self.judge_queue = asyncio.Queue()
+
+        async with channel:
+            self.stub = iruka_rpc_pb2_grpc.IrukaRpcStub(channel)
+            workers = [asyncio.ensure_future(self._slotWorker(slot))
+                       for slot in self.slots]
+            heartbeat = asyncio.ensure_future(self._heartbeat())
+            try:
+                while True:
+                    try:
+                        if await self.subscribeToServer(backoff) == False:
+                            return False
+                    except grpc.RpcError as err:
+                        if err.code() != grpc.StatusCode.UNAVAILABLE:
+                            raise
+                        logger.error('Error connecting to server (%s)', err.details())
+                        if not self.config.reconnect:
+                            return False
+
+                    if not self.config.reconnect:
+                        break
+                    delay = backoff.next()
+                    logger.info('Subscribing again in %.1f seconds...', delay)
+                    await asyncio.sleep(delay)
+            finally:
+                heartbeat.cancel()
+                # let the slots finish what has been accepted
+                for _ in workers:
+                    self.judge_queue.put_nowait(None)
+                await asyncio.gather(*workers)
+                if self.pending_reports:
+                    logger.error('Dropping %d reports never sent', len(self.pending_reports))
+                for executor in self.executors.values():
+                    executor.shutdown()
+            self.stub = None
+            self.checkers.close()
+            if self.history is not None:
+                self.history.close()
+
+    async def subscribeToServer(self, backoff=None):
+        stub = self.stub
+        config = self.config
+        ret = await stub.Version(empty_pb2.Empty())
+
+        events = stub.Listen(iruka_rpc_pb2.AuthenticateRequest(token=config.auth_token))
+        try:
+            auth_result = await events.read()
+        except grpc.RpcError as err:
+            if err.code() == grpc.StatusCode.UNAVAILABLE:
+                raise
+            logger.exception('Error to register client (%s)', err.code())
+            return False
+        if auth_result is grpc.aio.EOF:
+            logger.error('The subscription channel is closed before auth.')
+            return False
+
+        logger.info('Auth success.')
+        if backoff is not None:
+            backoff.reset()
+        try:
+            await self.flushPendingReportsAsync()
+        except grpc.RpcError:
+            events.cancel()
+            raise
+
+        # read() has been used on the call, so it cannot be iterated as well
+        while True:
+            event = await events.read()
+            if event is grpc.aio.EOF:
+                break
+            self.processRequest(event)
+
+        logger.info('The subscription channel is closed by the server.')
+
+    async def flushPendingReportsAsync(self):
+        with self.pending_lock:
+            reports = self.pending_reports
+            self.pending_reports = []
+
+        for i, events in enumerate(reports):
+            try:
+                await self.stub.ReportSubmission(iter(events))
+            except grpc.RpcError as err:
+                logger.error('Error sending deferred report (%s)', err.code())
+                with self.pending_lock:
+                    self.pending_reports[:0] = reports[i:]
+                raise
+        if reports:
+            logger.info('Sent %d deferred reports', len(reports))
+
+    def processRequest(self, event):
+        enum = iruka_rpc_pb2.ServerEvent
+        if event.type == enum.REQUEST_JUDGE:
+            logger.info('Request judge...')
+            self.judge_queue.put_nowait((event.submission_req, time.monotonic()))
+        else:
+            super().processRequest(event)
+
+    async def _slotWorker(self, slot):
+        while True:
+            item = await self.judge_queue.get()
+            if item is None:
+                break
+            req, enqueuedAt = item
+            logger.info('--- Server requested to judge %s on slot #%d ---',
+                pformat_pb(req), slot.index)
+            metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - enqueuedAt)
+            self.judging[slot.index] = req.submission_id
+            try:
+                await self._judge(req, slot)
+            except grpc.RpcError as err:
+                logger.exception('Error reporting submission (%s)', err.code())
+            finally:
+                del self.judging[slot.index]
+
+    async def _judge(self, req, slot):
+        '''Drive the blocking judge generator in the executor of `slot`, so
+        that it always runs on the same thread, and relay its events to the
+        report. Judging goes on if the connection is lost, and is stopped if
+        the report fails otherwise.'''
+        loop = asyncio.get_running_loop()
+        executor = self.executors[slot.index]
+        gen = iruka.handlers.judgeEvents(self, req, slot)
+        events = []
+        relayed = asyncio.Queue()
+        finishedAt = None
+
+        async def produce():
+            while True:
+                evt = await loop.run_in_executor(executor, next, gen, _END)
+                if evt is not _END:
+                    events.append(evt)
+                relayed.put_nowait(evt)
+                if evt is _END:
+                    break
+
+        async def relay():
+            nonlocal finishedAt
+            while True:
+                evt = await relayed.get()
+                if evt is _END:
+                    finishedAt = time.monotonic()
+                    break
+                yield evt
+
+        producer = asyncio.ensure_future(produce())
+        reported = False
+        try:
+            await self.stub.ReportSubmission(relay())
+            reported = True
+        except grpc.RpcError as err:
+            if err.code() != grpc.StatusCode.UNAVAILABLE:
+                raise
+            logger.warning('Connection lost while judging, continuing offline')
+            await producer
+            self.deferReport(events)
+            return
+        finally:
+            if not reported and not producer.done():
+                # the report failed otherwise; stop judging, on the thread of
+                # the slot once the pending step returns
+                producer.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await producer
+                await loop.run_in_executor(executor, gen.close)
+        if finishedAt is not None:
+            metrics.REPORT_SECONDS.observe(time.monotonic() - finishedAt)
+        await producer
+        logger.info('--- Judge completes, report sent ---')
+
+    async def _heartbeat(self):
+        enum = iruka_rpc_pb2.ClientStatus
+        while True:
+            await asyncio.sleep(self.config.heartbeat_interval)
+            status = iruka_rpc_pb2.ClientStatus(status=enum.IDLE)
+            if self.judging:
+                status.status = enum.BUSY
+                status.judging_id = next(iter(self.judging.values()))
+            try:
+                await self.stub.ReportStatus(status)
+            except grpc.RpcError as err:
+                logger.warning('Error reporting status (%s)', err.code())
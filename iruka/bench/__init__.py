@@ -0,0 +1,3 @@
+'''End-to-end benchmark of the client against a stand-in server in the same
+process. Run `python -m iruka.bench --help` for the options.
+'''
@@ -0,0 +1,122 @@
+'''Judge a generated corpus end to end, through a stand-in server in the same
+process, and report the throughput, the latency per submission and the time
+spent in each stage.
+
+It uses the config of the client (nsjail, workspace, caches, slots, ...), with
+the server and the testdata replaced.
+'''
+
+import logging
+import math
+import tempfile
+import time
+
+import click
+
+from iruka import metrics
+from iruka.bench.corpus import make_corpus
+from iruka.bench.server import (FakeIrukaServer, serve)
+from iruka.cli import (IrukaClient, loadConfig)
+from iruka.protos import common_pb2
+
+
+AUTH_TOKEN = 'bench'
+
+STAGES = (
+    ('queue wait', metrics.QUEUE_WAIT_SECONDS),
+    ('build', metrics.BUILD_SECONDS),
+    ('run', metrics.RUN_SECONDS),
+    ('check', metrics.CHECK_SECONDS),
+    ('report', metrics.REPORT_SECONDS),
+)
+
+
+def percentile(values, p):
+    '''The `p`-th percentile of sorted `values` by the nearest-rank method.'''
+    if not values:
+        return float('nan')
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def report(records, expected, elapsed):
+    done = [r for r in records if r.done_at is not None]
+    latencies = sorted(r.latency for r in done)
+
+    print('submissions   {} judged of {} in {:.2f}s'.format(
+        len(done), len(records), elapsed))
+    print('throughput    {:.2f} submissions/s'.format(len(done) / elapsed))
+    print('latency       p50 {:.3f}s  p99 {:.3f}s  max {:.3f}s'.format(
+        percentile(latencies, 50), percentile(latencies, 99),
+        latencies[-1] if latencies else float('nan')))
+
+    print('stages')
+    for name, histogram in STAGES:
+        count, total = histogram.totals()
+        mean = total / count if count else 0
+        print('  {:12} {:6d} x {:8.1f}ms = {:8.2f}s'.format(
+            name, count, mean * 1000, total))
+
+    mismatches = 0
+    for r in records:
+        want = expected[r.req.id]
+        if r.exception is not None:
+            got = 'exception: {}'.format(r.exception.message.splitlines()[0])
+        elif r.result is not None:
+            got = common_pb2.Verdict.Name(r.result.final_stat.verdict)
+        else:
+            got = 'no result'
+        if got != common_pb2.Verdict.Name(want):
+            mismatches += 1
+            print('  submission #{}: expected {}, got {}'.format(
+                r.req.id, common_pb2.Verdict.Name(want), got))
+    print('mismatches    {}'.format(mismatches))
+    return mismatches
+
+
+@click.command()
+@click.option('-c', '--config', 'config_path', help=
+    'The config file of judge client, default to `../iruka.yml`.')
+@click.option('-n', '--submissions', default=30, show_default=True)
+@click.option('--tasks', default=10, show_default=True,
+    help='Number of tasks of the problem, besides a sample.')
+@click.option('--size', default=10000, show_default=True,
+    help='Number of integers in the input of each task.')
+@click.option('--verdicts', default='AC,WA,TLE,MLE,OLE,CE', show_default=True,
+    help='The mix of submissions, by their expected verdicts.')
+@click.option('--same-code', is_flag=True,
+    help='Submit the same code for each verdict, to measure the build cache.')
+def main(config_path, submissions, tasks, size, verdicts, same_code):
+    logging.basicConfig(level=logging.WARNING)
+    config = loadConfig(config_path)
+    mix = [common_pb2.Verdict.Value(v.strip()) for v in verdicts.split(',')]
+
+    with tempfile.TemporaryDirectory(prefix='iruka-bench-') as root:
+        corpus = make_corpus(root, submissions, tasks, size,
+                             mix=mix, vary_code=not same_code)
+        expected = {req.id: verdict for verdict, req in corpus}
+        servicer = FakeIrukaServer([req for _, req in corpus], AUTH_TOKEN)
+        server, port = serve(servicer)
+
+        config.server = '127.0.0.1:{}'.format(port)
+        config.auth_token = AUTH_TOKEN
+        config.use_https = False
+        config.testdata_path = root
+        config.reconnect = False
+
+        if config.use_asyncio:
+            from iruka.aio_client import AsyncIrukaClient
+            client = AsyncIrukaClient(config)
+        else:
+            client = IrukaClient(config)
+
+        start = time.monotonic()
+        client.connect()
+        elapsed = time.monotonic() - start
+        server.stop(None)
+
+    mismatches = report(list(servicer.records.values()), expected, elapsed)
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
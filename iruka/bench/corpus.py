@@ -0,0 +1,117 @@
+'''A corpus of submissions to a generated problem, covering each verdict.
+
+The problem reads integers and prints their sum. It has one sample and a
+single group of `num_tasks` tasks, whose inputs have `size` integers each.
+'''
+
+import random
+from pathlib import Path
+
+from iruka.protos import (iruka_rpc_pb2, common_pb2)
+
+
+PROBLEM_ID = 1
+TIME_LIMIT = 1000
+MEM_LIMIT = 65536
+
+PROGRAMS = {
+    common_pb2.AC: r'''
+#include <cstdio>
+int main() {
+    long long x, s = 0;
+    while (scanf("%lld", &x) == 1) s += x;
+    printf("%lld\n", s);
+}
+''',
+    common_pb2.WA: r'''
+#include <cstdio>
+int main() {
+    long long x, s = 0;
+    while (scanf("%lld", &x) == 1) s += x;
+    printf("%lld\n", s + 1);
+}
+''',
+    common_pb2.TLE: r'''
+int main() {
+    volatile unsigned long long i = 0;
+    for (;;) ++i;
+}
+''',
+    common_pb2.MLE: r'''
+#include <cstdlib>
+#include <cstring>
+int main() {
+    for (;;) {
+        char *p = (char *) malloc(1 << 20);
+        if (p) memset(p, 1, 1 << 20);
+    }
+}
+''',
+    common_pb2.OLE: r'''
+#include <cstdio>
+int main() {
+    for (;;) puts("0000000000000000000000000000000");
+}
+''',
+    common_pb2.CE: r'''
+int main() { return }
+''',
+}
+
+
+def task_labels(num_tasks):
+    # as generated by hoj_to_judge_desc
+    labels = ['0']
+    if num_tasks > 1:
+        labels.extend('1-{}'.format(i + 1) for i in range(num_tasks))
+    else:
+        labels.append('1')
+    return labels
+
+
+def make_testdata(prob_dir, num_tasks, size, seed=0):
+    rng = random.Random(seed)
+    prob_dir = Path(prob_dir)
+    prob_dir.mkdir(parents=True, exist_ok=True)
+    for i, label in enumerate(task_labels(num_tasks)):
+        n = 3 if i == 0 else size
+        nums = [rng.randint(-10 ** 9, 10 ** 9) for _ in range(n)]
+        (prob_dir / '{}.in'.format(label)).write_text(
+            ' '.join(map(str, nums)) + '\n')
+        (prob_dir / '{}.out'.format(label)).write_text(
+            '{}\n'.format(sum(nums)))
+
+
+def make_spec(num_tasks, score=100):
+    '''The spec in the tabular format of HOJ.'''
+    rows = [[1, 1], [TIME_LIMIT, MEM_LIMIT], [num_tasks, 0, score]]
+    rows.extend([TIME_LIMIT, MEM_LIMIT] for _ in range(num_tasks))
+    return [common_pb2.Int64Array(value=row) for row in rows]
+
+
+def make_corpus(testdata_path, num_submissions, num_tasks, size, mix=None,
+                vary_code=True):
+    '''Generate the testdata under `testdata_path`, and return a list of
+    (expected verdict, SubmissionRequest). The verdicts cycle through `mix`,
+    all of PROGRAMS by default. With `vary_code`, every submission has a
+    distinct code and is compiled even with the build cache.'''
+    make_testdata(Path(testdata_path) / str(PROBLEM_ID), num_tasks, size)
+    mix = mix or list(PROGRAMS)
+    spec = make_spec(num_tasks)
+
+    corpus = []
+    for i in range(num_submissions):
+        verdict = mix[i % len(mix)]
+        code = PROGRAMS[verdict]
+        if vary_code:
+            code += '// {}\n'.format(i)
+        req = iruka_rpc_pb2.SubmissionRequest(
+            id=i + 1,
+            submission_id=i + 1,
+            submission=iruka_rpc_pb2.Submission(
+                problem_id=PROBLEM_ID,
+                code=code),
+            hoj_spec=spec,
+            hoj_type=iruka_rpc_pb2.SubmissionRequest.REGULAR)
+        corpus.append((verdict, req))
+    return corpus
@@ -0,0 +1,102 @@
+'''A stand-in of the Iruka server, which hands out a fixed list of submissions
+and records their results.'''
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+
+from iruka.protos import (iruka_rpc_pb2, iruka_rpc_pb2_grpc)
+
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionRecord(object):
+    def __init__(self, req):
+        self.req = req
+        self.sent_at = None
+        self.done_at = None
+        self.result = None
+        self.exception = None
+        self.num_partial_stats = 0
+
+    @property
+    def latency(self):
+        return self.done_at - self.sent_at
+
+
+class FakeIrukaServer(iruka_rpc_pb2_grpc.IrukaRpcServicer):
+    def __init__(self, requests, auth_token):
+        self.auth_token = auth_token
+        self.records = {req.id: SubmissionRecord(req) for req in requests}
+        self.statuses = []
+
+        self._pending = queue.Queue()
+        for req in requests:
+            self._pending.put(req)
+        self._remaining = len(requests)
+        self._lock = threading.Lock()
+        self.finished = threading.Event()
+        if not requests:
+            self.finished.set()
+
+    def Version(self, request, context):
+        return iruka_rpc_pb2.VersionInfo(version='bench', proto_revision=1)
+
+    def Listen(self, request, context):
+        if request.token != self.auth_token:
+            context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Bad token')
+        yield iruka_rpc_pb2.ServerEvent(type=iruka_rpc_pb2.ServerEvent.ACK)
+
+        while True:
+            try:
+                req = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            self.records[req.id].sent_at = time.monotonic()
+            yield iruka_rpc_pb2.ServerEvent(
+                type=iruka_rpc_pb2.ServerEvent.REQUEST_JUDGE,
+                submission_req=req)
+
+        # closing the stream tells the client to stop
+        self.finished.wait()
+
+    def ReportStatus(self, request, context):
+        self.statuses.append(request)
+        return iruka_rpc_pb2.GeneralResponse(ok=True)
+
+    def ReportSubmission(self, request_iterator, context):
+        record = None
+        for evt in request_iterator:
+            kind = evt.WhichOneof('event')
+            if kind == 'ack':
+                record = self.records[evt.ack.id]
+            elif record is None:
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION, 'Not acked')
+            elif kind == 'partial_stat':
+                record.num_partial_stats += 1
+            elif kind == 'result':
+                record.result = evt.result
+            elif kind == 'exception':
+                record.exception = evt.exception
+
+        if record is not None and record.done_at is None:
+            record.done_at = time.monotonic()
+            with self._lock:
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self.finished.set()
+        return iruka_rpc_pb2.GeneralResponse(ok=True)
+
+
+def serve(servicer, port=0, max_workers=16):
+    '''Start serving `servicer` on localhost and return (server, port).'''
+    server = grpc.server(ThreadPoolExecutor(max_workers=max_workers))
+    iruka_rpc_pb2_grpc.add_IrukaRpcServicer_to_server(servicer, server)
+    port = server.add_insecure_port('127.0.0.1:{}'.format(port))
+    server.start()
+    return server, port
@@ -0,0 +1,158 @@
+'''A content-addressed cache of compiled programs.
+
+Each entry is a directory named after the hex digest of everything that may
+affect the build result, holding the produced executable (if any) and the
+journals captured while compiling. Entries are evicted in the order they were
+least recently used once the total size exceeds the bound.
+'''
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+from iruka import metrics
+
+
+logger = logging.getLogger(__name__)
+
+ENTRY_META = 'meta.json'
+ENTRY_PROGRAM = 'program'
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version(compiler):
+    '''Query the version string of a compiler, which is part of the key.
+    The result is memoized for the lifetime of the process.'''
+    try:
+        subp = subprocess.run(
+            [compiler, '--version'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True)
+    except (OSError, subprocess.CalledProcessError):
+        logger.warning('Cannot determine the version of %s', compiler)
+        return ''
+    return subp.stdout.decode(errors='replace')
+
+
+class BuildCacheEntry(object):
+    def __init__(self, path, meta):
+        self.path = path
+        self.success = meta['success']
+        self.stdout = meta['stdout']
+        self.stderr = meta['stderr']
+        self.ole_stdout = meta['ole_stdout']
+        self.ole_stderr = meta['ole_stderr']
+
+    def install(self, output):
+        '''Copy the cached executable to `output`.'''
+        if self.success:
+            shutil.copy2(str(self.path / ENTRY_PROGRAM), str(output))
+
+
+class BuildCache(object):
+    def __init__(self, root, max_size):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(code, cmdline, compiler, context):
+        h = hashlib.sha256()
+        for part in (
+                code,
+                '\0'.join(cmdline),
+                compiler_version(compiler),
+                json.dumps(context, sort_keys=True)):
+            if isinstance(part, str):
+                part = part.encode()
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return h.hexdigest()
+
+    def lookup(self, key):
+        path = self.root / key
+        try:
+            with open(str(path / ENTRY_META), 'r') as f:
+                meta = json.load(f)
+            # bump the entry as the most recently used; it may have been
+            # evicted just now
+            os.utime(str(path))
+        except (OSError, ValueError):
+            self.misses += 1
+            metrics.CACHE_MISSES.inc('build')
+            logger.debug('Build cache miss: %s (%d hits, %d misses)',
+                key, self.hits, self.misses)
+            return None
+
+        self.hits += 1
+        metrics.CACHE_HITS.inc('build')
+        logger.debug('Build cache hit: %s (%d hits, %d misses)',
+            key, self.hits, self.misses)
+        return BuildCacheEntry(path, meta)
+
+    def store(self, key, *, success, output, stdout, stderr,
+              ole_stdout=False, ole_stderr=False):
+        path = self.root / key
+        # populate a staging directory first so that readers never see
+        # a partially written entry; it is unique to this call, since slots
+        # may store the same key at the same time
+        staging = None
+        try:
+            staging = Path(tempfile.mkdtemp(dir=str(self.root), prefix='.' + key + '.'))
+            if success:
+                shutil.copy2(str(output), str(staging / ENTRY_PROGRAM))
+            meta = {
+                'success': success,
+                'stdout': stdout,
+                'stderr': stderr,
+                'ole_stdout': ole_stdout,
+                'ole_stderr': ole_stderr,
+            }
+            with open(str(staging / ENTRY_META), 'w') as f:
+                json.dump(meta, f)
+            os.rename(str(staging), str(path))
+        except OSError:
+            # most likely another judge has stored the same entry
+            logger.debug('Cannot store build cache entry %s', key, exc_info=True)
+            if staging is not None:
+                shutil.rmtree(str(staging), ignore_errors=True)
+
+        self.evict()
+
+    def discard(self, key):
+        '''Remove a broken entry.'''
+        logger.warning('Discarding build cache entry %s', key)
+        shutil.rmtree(str(self.root / key), ignore_errors=True)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for path in self.root.iterdir():
+            if path.name.startswith('.'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in path.iterdir())
+                entries.append((path.stat().st_mtime, size, path))
+            except OSError:
+                # evicted by another slot meanwhile
+                continue
+            total += size
+
+        # least recently used first
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            logger.debug('Evicting build cache entry %s', path.name)
+            shutil.rmtree(str(path), ignore_errors=True)
+            total -= size
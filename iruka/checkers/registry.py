@@ -0,0 +1,239 @@
+'''Resolve the checker of a problem once, and keep it around for later test
+cases and submissions.
+
+Python checkers are modules providing `main(CheckerInput) -> CheckerOutput`,
+imported once. A special judge is a program compiled from the source in the
+testdata directory of the problem, and run as a pool of long-lived workers.
+A worker reads `CheckerInput` messages from stdin and answers each of them with
+a `CheckerOutput` on stdout, until stdin is closed. Each message is framed by
+its length as a 4-byte little-endian unsigned integer.
+'''
+
+import importlib
+import logging
+import queue
+import struct
+import subprocess
+import threading
+from pathlib import Path
+
+from iruka.exceptions import IrukaInternalError
+from iruka.protos import (iruka_rpc_pb2, checker_io_pb2)
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKER = 'iruka.checkers.tolerant_diff'
+SPECIAL_JUDGE_CMDLINE = ['g++', '-O2', '-o']
+
+_LENGTH = struct.Struct('<I')
+
+
+def write_message(f, message):
+    data = message.SerializeToString()
+    f.write(_LENGTH.pack(len(data)))
+    f.write(data)
+    f.flush()
+
+
+def read_message(f, message_class):
+    header = f.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        raise EOFError()
+    length, = _LENGTH.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        raise EOFError()
+    message = message_class()
+    message.ParseFromString(data)
+    return message
+
+
+class PythonChecker(object):
+    def __init__(self, module_name):
+        self.module = importlib.import_module(module_name)
+        # the module can also compare the output while it is produced
+        self.streamable = hasattr(self.module, 'StreamingDiff')
+
+    def check(self, checker_input):
+        return self.module.main(checker_input)
+
+    def open_stream(self, path_outfile):
+        return self.module.StreamingDiff(path_outfile)
+
+    def stream_result(self, diff_at, checker_input):
+        return self.module.make_output(diff_at, checker_input.context)
+
+    def close(self):
+        pass
+
+
+class _SpecialJudgeWorker(object):
+    def __init__(self, program):
+        self.process = subprocess.Popen(
+            [str(program)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def call(self, checker_input):
+        write_message(self.process.stdin, checker_input)
+        return read_message(self.process.stdout, checker_io_pb2.CheckerOutput)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class SpecialJudgeChecker(object):
+    streamable = False
+
+    def __init__(self, program, num_workers):
+        self.program = program
+        self.num_workers = num_workers
+
+        # idle workers, and None for each worker retired, to wake a waiter
+        # up to spawn another
+        self._idle = queue.Queue()
+        self._spawned = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def check(self, checker_input):
+        worker = self._acquire()
+        try:
+            return worker.call(checker_input)
+        except (OSError, EOFError):
+            # do not return a broken worker to the pool
+            self._retire(worker)
+            worker = None
+            raise IrukaInternalError(
+                'Special judge {} exited unexpectedly'.format(self.program))
+        finally:
+            if worker is not None:
+                self._release(worker)
+
+    def close(self):
+        '''Terminate idle workers now, and busy ones once they are released.'''
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.close()
+
+    def _acquire(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    spawn = self._spawned < self.num_workers
+                    if spawn:
+                        self._spawned += 1
+                if spawn:
+                    logger.debug('Spawning a worker of special judge %s', self.program)
+                    return _SpecialJudgeWorker(self.program)
+                worker = self._idle.get()
+            if worker is not None:
+                return worker
+
+    def _release(self, worker):
+        with self._lock:
+            if not self._closed:
+                self._idle.put(worker)
+                return
+        self._retire(worker)
+
+    def _retire(self, worker):
+        with self._lock:
+            self._spawned -= 1
+        worker.close()
+        self._idle.put(None)
+
+
+class CheckerRegistry(object):
+    def __init__(self, config):
+        self.build_path = Path(config.workspace_path) / 'checkers'
+        self.special_judge_source = config.special_judge_source
+        self.num_workers = config.special_judge_workers
+
+        self._python_checkers = {}
+        # problem_id -> (source digest, checker)
+        self._special_judges = {}
+        # problem_id -> lock held while resolving its special judge, so that
+        # compiling one does not block the others
+        self._problem_locks = {}
+        self._lock = threading.Lock()
+
+        self.build_path.mkdir(parents=True, exist_ok=True)
+
+    def resolve(self, problem_id, hoj_type, manifest):
+        enum = iruka_rpc_pb2.SubmissionRequest
+        if hoj_type == enum.SPECIAL_JUDGE:
+            return self._resolve_special_judge(problem_id, manifest)
+        with self._lock:
+            return self._resolve_python(DEFAULT_CHECKER)
+
+    def close(self):
+        with self._lock:
+            for _, checker in self._special_judges.values():
+                checker.close()
+            self._special_judges = {}
+
+    def _resolve_python(self, module_name):
+        checker = self._python_checkers.get(module_name)
+        if checker is None:
+            checker = PythonChecker(module_name)
+            self._python_checkers[module_name] = checker
+        return checker
+
+    def _resolve_special_judge(self, problem_id, manifest):
+        name = self.special_judge_source
+        if name not in manifest:
+            raise IrukaInternalError(
+                'Special judge {} for problem id {} is not ready'.format(name, problem_id))
+        source = manifest[name]
+
+        with self._lock:
+            problem_lock = self._problem_locks.setdefault(problem_id, threading.Lock())
+
+        with problem_lock:
+            with self._lock:
+                resolved = self._special_judges.get(problem_id)
+            if resolved is not None and resolved[0] == source.digest:
+                return resolved[1]
+
+            program = self.build_path / source.digest
+            if not program.is_file():
+                self._compile(source.path, program)
+
+            checker = SpecialJudgeChecker(program, self.num_workers)
+            with self._lock:
+                resolved = self._special_judges.get(problem_id)
+                self._special_judges[problem_id] = (source.digest, checker)
+            if resolved is not None:
+                # the source has changed
+                resolved[1].close()
+            return checker
+
+    def _compile(self, source, program):
+        logger.info('Compiling special judge %s', source)
+        # problems may share the same source, and compile it at the same time
+        staging = program.parent / '{}.{}.tmp'.format(
+            program.name, threading.get_ident())
+        subp = subprocess.run(
+            SPECIAL_JUDGE_CMDLINE + [str(staging), str(source)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        if subp.returncode != 0:
+            raise IrukaInternalError(
+                'Failed to compile special judge {}'.format(source),
+                details=subp.stdout.decode(errors='replace'))
+        staging.rename(program)
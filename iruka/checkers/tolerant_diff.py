@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
+import codecs
+import io
 import logging
+import mmap
 import os
 import re
 import sys
+from operator import methodcaller
 from os import path
 
 # from google.protobuf.wrappers_pb2 import Int64Value
@@ -14,16 +18,147 @@ from os import path
 from ..protos import (common_pb2, checker_io_pb2)
 
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('checkers.tolerant_diff')
 
 def strip_eol(s):
-    last = -1
-    while s and (s[last] in ('\r', '\n')):
+    last = len(s)
+    while last and (s[last - 1] in ('\r', '\n')):
         last -= 1
     return s[:last]
 
 
+# the bytes engine below works on UTF-8 encoded output, with the same rules
+# as comparing lines decoded in text mode with str.strip()
+CHUNK_SIZE = 1024 * 1024
+
+# what str.isspace() accepts in ASCII
+_ASCII_WS = bytes(c for c in range(128) if chr(c).isspace())
+_strip_ascii_ws = methodcaller('strip', _ASCII_WS)
+
+
+def _normalize(chunk, final):
+    '''Normalize a chunk of whole lines, so that each line has surrounding
+    whitespace removed and is terminated by a single b'\\n'.'''
+    # universal newlines
+    chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if final and chunk and not chunk.endswith(b'\n'):
+        chunk += b'\n'
+    if chunk.isascii():
+        return b'\n'.join(map(_strip_ascii_ws, chunk.split(b'\n')))
+    # let str.strip() handle whitespace beyond ASCII; invalid bytes survive
+    # the round trip as surrogates
+    text = chunk.decode('utf-8', 'surrogateescape')
+    text = '\n'.join(map(str.strip, text.split('\n')))
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def _normalized_chunks(buf, start):
+    '''Yield normalized chunks of whole lines of `buf` from `start`, which
+    should be the beginning of a line.'''
+    size = len(buf)
+    pos = start
+    while pos < size:
+        end = min(pos + CHUNK_SIZE, size)
+        while end < size:
+            # a trailing '\r' may be the first half of '\r\n'
+            cut = max(buf.rfind(b'\n', pos, end), buf.rfind(b'\r', pos, end - 1))
+            if cut >= 0:
+                end = cut + 1
+                break
+            # a line longer than a chunk
+            end = min(end + CHUNK_SIZE, size)
+
+        yield _normalize(buf[pos:end], end == size)
+        pos = end
+
+
+def _first_diff(a, b, start, end):
+    '''Index of the first differing byte of a[start:end] and b[start:end],
+    or `end` if they are the same.'''
+    pos = start
+    while pos < end:
+        nxt = min(pos + CHUNK_SIZE, end)
+        if a[pos:nxt] != b[pos:nxt]:
+            lo, hi = pos, nxt
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if a[lo:mid] == b[lo:mid]:
+                    lo = mid
+                else:
+                    hi = mid
+            return lo
+        pos = nxt
+    return end
+
+
+def _count_lines(buf, end):
+    '''Number of lines in buf[:end], which ends at the beginning of a line.'''
+    count = 0
+    last = b''
+    for pos in range(0, end, CHUNK_SIZE):
+        chunk = buf[pos:min(pos + CHUNK_SIZE, end)]
+        count += chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+        # '\r\n' split between chunks
+        if last == b'\r' and chunk[:1] == b'\n':
+            count -= 1
+        last = chunk[-1:]
+    return count
+
+
+def _map(f):
+    # empty files cannot be mapped
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def tolerant_diff_mapped(path_a, path_b):
+    '''The same as tolerant_diff_at, but works on memory-mapped bytes of the
+    files in bulk rather than line by line. Only the part after the first
+    differing byte is normalized line by line.'''
+    with open(path_a, 'rb') as fa, open(path_b, 'rb') as fb:
+        buf_a, buf_b = _map(fa), _map(fb)
+        try:
+            return _diff_buffers(buf_a, buf_b)
+        finally:
+            for buf in (buf_a, buf_b):
+                if isinstance(buf, mmap.mmap):
+                    buf.close()
+
+
+def _diff_buffers(buf_a, buf_b):
+    common = min(len(buf_a), len(buf_b))
+    pos = _first_diff(buf_a, buf_b, 0, common)
+    if pos == len(buf_a) == len(buf_b):
+        return -1
+
+    # back off to the beginning of the line where they start to differ; a
+    # '\r' right before may be part of '\r\n' in only one of them
+    if pos > 0 and buf_a[pos - 1:pos] == b'\r':
+        pos -= 1
+    start = max(buf_a.rfind(b'\n', 0, pos), buf_a.rfind(b'\r', 0, pos)) + 1
+    line = _count_lines(buf_a, start)
+
+    it_a = _normalized_chunks(buf_a, start)
+    it_b = _normalized_chunks(buf_b, start)
+    pend_a, pend_b = b'', b''
+    while True:
+        if not pend_a:
+            pend_a = next(it_a, b'')
+        if not pend_b:
+            pend_b = next(it_b, b'')
+        if not pend_a or not pend_b:
+            # the same so far, unless one has more lines than the other
+            return line if (pend_a or pend_b) else -1
+
+        n = min(len(pend_a), len(pend_b))
+        diff = _first_diff(pend_a, pend_b, 0, n)
+        if diff < n:
+            return line + pend_a.count(b'\n', 0, diff)
+        line += pend_a.count(b'\n', 0, n)
+        pend_a, pend_b = pend_a[n:], pend_b[n:]
+
+
 def tolerant_diff_at(fa, fb):
     line = 0
     while True:
@@ -37,34 +172,66 @@ def tolerant_diff_at(fa, fb):
         line += 1
     return -1
 
-def main(checker_input):
-    pathOut = checker_input.path_outfile
-    pathOut_user = checker_input.path_out_user
-    context = checker_input.context
+class StreamingDiff(object):
+    '''Compare the output against the expected output file as it arrives,
+    with the same rules as tolerant_diff_at. It is meant to be the destination
+    of a pipe; once a line differs, the rest of the output is discarded.'''
+
+    def __init__(self, path_expected):
+        self._expected = open(path_expected, 'r')
+        # decode and split lines the same way as files opened in text mode
+        self._decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder('utf-8')(errors='replace'),
+            translate=True)
+        self._pending = ''
+        self._line = 0
+        # the first differing line (0-indexed), once known
+        self.diff_at = None
 
+    def write(self, buf):
+        if self.diff_at is None:
+            self._feed(self._decoder.decode(buf))
+        return len(buf)
 
-    fOut_user = open(pathOut_user, 'r')
-    fOut = open(pathOut, 'r')
+    def finish(self):
+        '''Call after the output ends. Return the first differing line, or -1
+        if none, as tolerant_diff_at does.'''
+        if self.diff_at is None:
+            self._feed(self._decoder.decode(b'', final=True))
+        if self.diff_at is None and self._pending:
+            self._compare(self._pending)
+        if self.diff_at is None and self._expected.readline():
+            self.diff_at = self._line
+        self._expected.close()
+        return -1 if self.diff_at is None else self.diff_at
 
-    fOut_user = open(pathOut_user, 'r')
-    fOut = open(pathOut, 'r')
-    diffResult = tolerant_diff_at(fOut_user, fOut)
-    fOut_user.close()
-    fOut.close()
+    def _feed(self, text):
+        lines = (self._pending + text).split('\n')
+        self._pending = lines.pop()
+        for ln in lines:
+            if not self._compare(ln + '\n'):
+                break
 
-    f1 = open(pathOut_user, 'r')
-    f2 = open(pathOut, 'r')
+    def _compare(self, la):
+        lb = self._expected.readline()
+        if not lb or strip_eol(la.strip()) != strip_eol(lb.strip()):
+            self.diff_at = self._line
+            return False
+        self._line += 1
+        return True
 
-    if diffResult >= 0:
-        logger.debug('Rejected - Line #{} differs'.format(diffResult + 1))
+
+def make_output(diff_result, context):
+    if diff_result >= 0:
+        logger.debug('Rejected - Line #{} differs'.format(diff_result + 1))
     else:
         logger.debug('Accepted - No differences found')
 
     output = checker_io_pb2.CheckerOutput()
-    # output.meta['lineno'].Pack(Int64Value(value=diffResult + 1))
+    # output.meta['lineno'].Pack(Int64Value(value=diff_result + 1))
 
     if context.stat.verdict == 0:
-        if diffResult >= 0:
+        if diff_result >= 0:
             output.verdict = common_pb2.WA
         else:
             output.verdict = common_pb2.AC
@@ -72,9 +239,22 @@ def main(checker_input):
     return output
 
 
+def main(checker_input):
+    pathOut = checker_input.path_outfile
+    pathOut_user = checker_input.path_out_user
+    context = checker_input.context
+
+
+    diffResult = tolerant_diff_mapped(pathOut_user, pathOut)
+
+    return make_output(diffResult, context)
+
+
 # writing an interface for debugging is extremely helpful
 # but not absolutely necessary
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+
     if len(sys.argv) < 3:
         print('Usage: python -m {} out out_user'.format(__spec__.name))
         sys.exit(1)
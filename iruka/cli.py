@@ -1,18 +1,27 @@
-import argparse
 import click
 import logging
 import logging.config
 import os
+import queue
 import sys
+import threading
+import time
 from pathlib import Path
 
 import grpc
 import yaml
 from google.protobuf import empty_pb2
-from google.protobuf import text_format
 import iruka.handlers
 from iruka.protos import (iruka_rpc_pb2, iruka_rpc_pb2_grpc)
-from iruka.config import Config
+from iruka import (metrics, profiling)
+from iruka.build_cache import BuildCache
+from iruka.checkers.registry import CheckerRegistry
+from iruka.history import JudgeHistory
+from iruka.config import loadConfig
+from iruka.sandbox import SandboxPool
+from iruka.short_circuit import validate_policies
+from iruka.testdata import (ManifestIndex, TestdataCache)
+from iruka.utils.backoff import Backoff
 
 
 BASE_PATH = Path(__file__).parent.absolute()
@@ -20,21 +29,16 @@ logging.Formatter.default_msec_format = '%s.%03d'
 logger = logging.getLogger(__name__)
 
 
-# the same mechanism used in server
-def loadConfig(path=None, configClass=Config):
-    if path is None:
-        try:
-            path_dfl = BASE_PATH / '../iruka.yml'
-            path = path_dfl.resolve(strict=True)
-        except FileNotFoundError:
-            raise FileNotFoundError(
-                'The default config file "{}" does not exist. Specify one by --config.'.format(path_dfl.resolve()))
+class JudgeSlot(object):
+    '''A worker slot that judges one submission at a time, with a workspace,
+    a share of CPU cores and a pool of sandboxes of its own.'''
+    def __init__(self, index, workspace, cpus, sandboxes):
+        self.index = index
+        self.workspace = Path(workspace)
+        self.cpus = cpus
+        self.sandboxes = sandboxes
 
-    with open(path, 'r') as f:
-        d = yaml.safe_load(f)
-    config = configClass()
-    config.load_from_dict(d)
-    return config
+        self.workspace.mkdir(parents=True, exist_ok=True)
 
 
 class IrukaClient(object):
@@ -48,31 +52,120 @@ class IrukaClient(object):
         if not p_nsjail.is_file():
             raise ValueError('nsjail_path should point to a file.')
         logger.debug('Using nsjail at: %s', p_nsjail.absolute())
+        validate_policies(config.short_circuit)
+        if config.profile_path:
+            profiling.validate_mode(config.profile_mode)
+            Path(config.profile_path).mkdir(parents=True, exist_ok=True)
+
+        self.build_cache = None
+        if config.build_cache_path:
+            self.build_cache = BuildCache(
+                config.build_cache_path, config.build_cache_max_size)
+            logger.debug('Using build cache at: %s', config.build_cache_path)
+
+        self.checkers = CheckerRegistry(config)
+        self.testdata_index = ManifestIndex(config.testdata_manifest_ttl)
+        self.testdata_cache = None
+        if config.testdata_cache_path:
+            self.testdata_cache = TestdataCache(
+                config.testdata_cache_path, config.testdata_cache_max_size)
+            logger.debug('Using testdata cache at: %s', config.testdata_cache_path)
+
+        self.history = None
+        if config.history_path:
+            self.history = JudgeHistory(config.history_path)
+            logger.debug('Using judge history at: %s', config.history_path)
+
+        # partition the cores among slots so that their runs never collide
+        cpus = config.parallel_cpus or sorted(os.sched_getaffinity(0))
+        num_slots = config.judge_slots
+        self.slots = [
+            JudgeSlot(i, Path(config.workspace_path) / 'slot{}'.format(i),
+                      cpus[i::num_slots],
+                      SandboxPool(config.nsjail_path,
+                                  iruka.handlers.NSJAIL_CFG_PATH.absolute(),
+                                  config.parallel_runs))
+            for i in range(num_slots)]
+        self.judge_queue = queue.Queue()
+
+        if config.metrics_port:
+            metrics.start_http_server(config.metrics_port)
+        if config.metrics_file:
+            metrics.start_file_dumper(config.metrics_file, config.metrics_interval)
+
+        # events of judges to be reported after reconnecting
+        self.pending_reports = []
+        self.pending_lock = threading.Lock()
+
+    def channelArgs(self):
+        '''The target, credentials (None if insecure) and options to open
+        the channel with.'''
+        config = self.config
+        creds = None
+        if config.use_https:
+            with open(config.ssl_root_ca, 'rb') as f:
+                creds = grpc.ssl_channel_credentials(f.read())
+        options = [
+            ('grpc.keepalive_time_ms', int(config.keepalive_time * 1000)),
+            ('grpc.keepalive_timeout_ms', int(config.keepalive_timeout * 1000)),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+        ]
+        return config.server, creds, options
 
     def connect(self):
-        # TODO: try to presist connection if the server
-        # tells that the shutdown is temporatory
-        try:
-            logger.debug('Connecting to {}...'.format(self.config.server))
-            if self.config.use_https:
-                with open(self.config.ssl_root_ca, 'rb') as f:
-                    creds = grpc.ssl_channel_credentials(f.read())
-                channel_thunk = lambda: grpc.secure_channel(self.config.server, creds)
-            else:
-                channel_thunk = lambda: grpc.insecure_channel(self.config.server)
-
-            with channel_thunk() as channel:
-                self.stub = iruka_rpc_pb2_grpc.IrukaRpcStub(channel)
-                self.subscribeToServer()
+        # the channel lives as long as the client, and gRPC reconnects it
+        # transparently; only the subscription has to be made again
+        logger.debug('Connecting to {}...'.format(self.config.server))
+        target, creds, options = self.channelArgs()
+        if creds is not None:
+            channel = grpc.secure_channel(target, creds, options)
+        else:
+            channel = grpc.insecure_channel(target, options)
+
+        backoff = Backoff(
+            self.config.reconnect_backoff_min, self.config.reconnect_backoff_max)
+        workers = [
+            threading.Thread(
+                target=self._slotWorker, args=(slot,),
+                name='slot{}'.format(slot.index))
+            for slot in self.slots]
+
+        with channel:
+            self.stub = iruka_rpc_pb2_grpc.IrukaRpcStub(channel)
+            for worker in workers:
+                worker.start()
+            try:
+                while True:
+                    try:
+                        if self.subscribeToServer(backoff) == False:
+                            return False
+                    except grpc.RpcError as err:
+                        if err.code() != grpc.StatusCode.UNAVAILABLE:
+                            raise
+                        logger.error('Error connecting to server (%s)', err.details())
+                        if not self.config.reconnect:
+                            return False
+
+                    if not self.config.reconnect:
+                        break
+                    delay = backoff.next()
+                    logger.info('Subscribing again in %.1f seconds...', delay)
+                    time.sleep(delay)
+            finally:
+                # let the slots finish what has been accepted
+                for _ in workers:
+                    self.judge_queue.put(None)
+                for worker in workers:
+                    worker.join()
+                if self.pending_reports:
+                    logger.error('Dropping %d reports never sent', len(self.pending_reports))
             self.stub = None
-        except grpc.RpcError as err:
-            if err.code() == grpc.StatusCode.UNAVAILABLE:
-                logger.exception('Error connecting to server')
-                return False
-            else:
-                raise
+            self.checkers.close()
+            if self.history is not None:
+                self.history.close()
 
-    def subscribeToServer(self):
+    def subscribeToServer(self, backoff=None):
         stub = self.stub
         config = self.config
         ret = stub.Version(empty_pb2.Empty())
@@ -81,21 +174,65 @@ class IrukaClient(object):
         try:
             auth_result = next(events)
         except grpc.RpcError as err:
+            if err.code() == grpc.StatusCode.UNAVAILABLE:
+                raise
             logger.exception('Error to register client (%s)', err.code())
             return False
 
         logger.info('Auth success.')
+        if backoff is not None:
+            backoff.reset()
+        try:
+            self.flushPendingReports()
+        except grpc.RpcError:
+            events.cancel()
+            raise
 
         for event in events:
             self.processRequest(event)
 
         logger.info('The subscription channel is closed by the server.')
 
+    def deferReport(self, events):
+        '''Keep the events of a judge whose report failed to be sent, to be
+        sent again after subscribing again.'''
+        with self.pending_lock:
+            self.pending_reports.append(events)
+        logger.warning('Report deferred until reconnected (%d pending)',
+            len(self.pending_reports))
+
+    def flushPendingReports(self):
+        with self.pending_lock:
+            reports = self.pending_reports
+            self.pending_reports = []
+
+        for i, events in enumerate(reports):
+            try:
+                self.stub.ReportSubmission(iter(events))
+            except grpc.RpcError as err:
+                logger.error('Error sending deferred report (%s)', err.code())
+                with self.pending_lock:
+                    self.pending_reports[:0] = reports[i:]
+                raise
+        if reports:
+            logger.info('Sent %d deferred reports', len(reports))
+
+    def _slotWorker(self, slot):
+        while True:
+            item = self.judge_queue.get()
+            if item is None:
+                break
+            req, enqueuedAt = item
+            try:
+                iruka.handlers.requestJudge(self, req, slot, enqueuedAt)
+            except grpc.RpcError as err:
+                logger.exception('Error reporting submission (%s)', err.code())
+
     def processRequest(self, event):
         enum = iruka_rpc_pb2.ServerEvent
         if event.type == enum.REQUEST_JUDGE:
             logger.info('Request judge...')
-            iruka.handlers.requestJudge(self, event.submission_req)
+            self.judge_queue.put((event.submission_req, time.monotonic()))
         elif event.type == enum.ABORT_TASK:
             logger.info('Abort task...')
             raise NotImplementedError()
@@ -106,18 +243,75 @@ class IrukaClient(object):
             logger.error('Unknown or unexpected request {!r}'.format(event))
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('-c', '--config', 'config_path', help=
     'The config file of judge client, default to `../iruka.yml`.')
-def cli(config_path):
+@click.pass_context
+def cli(ctx, config_path):
     ''' \U0001f42c Iruka, the backend of NeoHOJ. '''
+    ctx.obj['config_path'] = config_path
+    if ctx.invoked_subcommand is not None:
+        return
+
     config = loadConfig(config_path)
 
-    app = IrukaClient(config)
+    if config.use_asyncio:
+        from iruka.aio_client import AsyncIrukaClient
+        app = AsyncIrukaClient(config)
+    else:
+        app = IrukaClient(config)
     exitCode = (1 if app.connect() == False else 0)
     sys.exit(exitCode)
 
 
+@cli.command('judge-local')
+@click.option('-p', '--problem', 'problemId', type=int, required=True,
+    help='The id of the problem, whose testdata is under testdata_path.')
+@click.option('-s', '--spec', 'specPath', required=True, help=
+    'The spec of the problem in the tabular format of HOJ, as a JSON or YAML list of lists.')
+@click.option('--testdata', 'testdataPath', help=
+    'The directory holding the testdata of problems, default to testdata_path.')
+@click.option('--special-judge', 'specialJudge', is_flag=True, help=
+    'Judge with the special judge of the problem.')
+@click.option('-j', '--workers', type=int, help=
+    'Number of submissions judged at the same time, default to judge_slots.')
+@click.option('-o', '--output', default='results.jsonl', show_default=True)
+@click.option('-f', '--format', 'fmt', default='jsonl', show_default=True,
+    type=click.Choice(['jsonl', 'pb']), help=
+    'jsonl writes a JSON object per line; pb writes SubmissionEvent messages, '
+    'each prefixed by its length as a little-endian uint32.')
+@click.option('--profile', 'profilePath', help=
+    'Profile judging every submission into this directory, see profile_mode.')
+@click.argument('sources', nargs=-1, required=True)
+@click.pass_context
+def judgeLocal(ctx, problemId, specPath, testdataPath, specialJudge, workers,
+               output, fmt, profilePath, sources):
+    '''Judge SOURCES (files, or directories of *.cpp) against a problem
+    without the server.'''
+    from iruka import local_judge
+
+    config = loadConfig(ctx.obj['config_path'])
+    if testdataPath is not None:
+        config.testdata_path = testdataPath
+    if workers is not None:
+        config.judge_slots = workers
+    if profilePath is not None:
+        config.profile_path = profilePath
+        config.profile_rate = 1.0
+    hojType = (iruka_rpc_pb2.SubmissionRequest.SPECIAL_JUDGE if specialJudge
+               else iruka_rpc_pb2.SubmissionRequest.REGULAR)
+
+    app = IrukaClient(config)
+    try:
+        local_judge.judge_local(
+            app, local_judge.collect_sources(sources), problemId,
+            local_judge.load_spec(specPath), hojType, output, fmt)
+    finally:
+        app.checkers.close()
+        if app.history is not None:
+            app.history.close()
+
+
 def main(as_module=False):
     # duplicate
     log_config_path = Path(
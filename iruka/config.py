@@ -1,7 +1,115 @@
+from pathlib import Path
+
+
+BASE_PATH = Path(__file__).parent.absolute()
+
+
 class Config(object):
     def __init__(self):
         self.server = None
         self.auth_token = None
 
+        # serve the server and the judge slots with an asyncio event loop
+        # instead of a thread per slot
+        self.use_asyncio = False
+        # seconds between status reports to the server, with use_asyncio
+        self.heartbeat_interval = 10
+
+        # seconds between keepalive pings, and to wait for their replies
+        self.keepalive_time = 30
+        self.keepalive_timeout = 10
+        # subscribe again once the server goes away, with delays growing
+        # exponentially from reconnect_backoff_min to reconnect_backoff_max
+        # seconds in between
+        self.reconnect = True
+        self.reconnect_backoff_min = 1
+        self.reconnect_backoff_max = 60
+
+        # set build_cache_path to cache compiled programs across submissions
+        self.build_cache_path = None
+        self.build_cache_max_size = 1024 * 1024 * 1024
+
+        # seconds before manifests of testdata are checked again even if their
+        # directories are unchanged; None to trust the mtime of directories
+        self.testdata_manifest_ttl = 600
+
+        # set testdata_cache_path to keep local copies of testdata, preferably
+        # on tmpfs
+        self.testdata_cache_path = None
+        self.testdata_cache_max_size = 1024 * 1024 * 1024
+
+        # number of submissions judged at the same time, each in a workspace
+        # of its own under workspace_path
+        self.judge_slots = 1
+        self.workspace_path = '/run/shm/judge'
+
+        # number of subtasks run at the same time; 1 runs them serially
+        self.parallel_runs = 1
+        # cores to pin the runs to, default to all usable ones; they are
+        # divided evenly among judge slots
+        self.parallel_cpus = None
+
+        # a program is stopped once its CPU time exceeds the time limit plus
+        # time_limit_grace (ms), or its wall time exceeds the time limit times
+        # wall_time_ratio plus time_limit_grace
+        self.time_limit_grace = 50
+        self.wall_time_ratio = 1.5
+
+        # compare the output while the program runs, and stop it at the first
+        # differing line instead of writing the output to a file
+        self.streaming_check = False
+
+        # the source of special judges in the testdata directory of problems,
+        # and the number of processes each of them runs at most
+        self.special_judge_source = 'checker.cpp'
+        self.special_judge_workers = 2
+
+        # policies to skip tasks once the result is decided, see
+        # iruka.short_circuit
+        self.short_circuit = []
+        # record how subtasks of each problem are judged in this SQLite
+        # database; with short_circuit, the tasks of each group most likely to
+        # fail are then run first
+        self.history_path = None
+
+        # minimum seconds between reports of finished subtasks; finished
+        # subtasks are batched in between
+        self.partial_stat_interval = 1.0
+
+        # serve metrics on this local port, and/or dump them to metrics_file
+        # every metrics_interval seconds
+        self.metrics_port = None
+        self.metrics_file = None
+        self.metrics_interval = 15
+
+        # profile judging a profile_rate fraction of submissions, writing a
+        # file per judge to profile_path, named by the submission id, the
+        # request id and the time; profile_mode is cprofile, or sampling with
+        # a sample every profile_interval seconds
+        self.profile_path = None
+        self.profile_rate = 1.0
+        self.profile_mode = 'sampling'
+        self.profile_interval = 0.005
+
     def load_from_dict(self, config_dict):
         self.__dict__.update(config_dict)
+
+
+# the same mechanism used in server
+def loadConfig(path=None, configClass=Config):
+    # only needed here, so that importing Config stays cheap
+    import yaml
+
+    if path is None:
+        try:
+            path_dfl = BASE_PATH / '../iruka.yml'
+            path = path_dfl.resolve(strict=True)
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                'The default config file "{}" does not exist. Specify one by --config.'.format(path_dfl.resolve()))
+
+    with open(path, 'r') as f:
+        d = yaml.safe_load(f)
+    config = configClass()
+    config.load_from_dict(d)
+    return config
@@ -2,26 +2,162 @@ import shlex
 import io
 import os
 import logging
+import queue
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import grpc
 from colors import color
 
 import iruka._hoj_helpers as hoj_helpers
+from iruka import (metrics, profiling)
 from iruka.common.utils import (pformat, pformat_pb)
 from iruka.verdict import Verdict
 from iruka.pipeline import JudgePipeline
+from iruka.short_circuit import ShortCircuit
 from iruka.protos import (iruka_rpc_pb2, subtask_pb2, checker_io_pb2, common_pb2)
 from iruka.exceptions import IrukaInternalError
 
 
 logger = logging.getLogger(__name__)
 
-LOG_STDOUT_PATH = '/tmp/judge.stdout.log'
-LOG_STDERR_PATH = '/tmp/judge.stderr.log'
+# file names in the workspace of a judge slot
+USERCODE_NAME = 'program.cpp'
+PROGRAM_NAME = 'program'
 
+NSJAIL_CFG_PATH = Path('./nsjail-configs/nsjail.cfg')
 
-def judgeSubmission(irukaClient, req):
+SKIPPED_RESULT = (common_pb2.SKIPPED, None)
+
+
+def _runSubtask(pipeline, task_idx, task, test_files, cwd):
+    tgid, indexed_subtask = task
+    gidx, subtask = indexed_subtask
+    logger.info('--- Task #%d, %d-%d: %r', task_idx, tgid, gidx, subtask)
+
+    run = pipeline.pl_run(
+        indexed_subtask,
+        test_files[0],
+        cwd=cwd,
+        exec=['./' + PROGRAM_NAME],
+        outfile_path=test_files[1])
+
+    # inspect jail_report to decide whether to skip checking
+    verdict = pipeline._determine_verdict(run, subtask.time_limit)
+
+    if verdict == 0:
+        checker_out = pipeline.pl_check(test_files, run)
+        verdict = checker_out.verdict
+        if verdict == common_pb2.WA:
+            logger.info(color('===== WA  =====', fg='red', style='negative'))
+        else:
+            logger.info(color('===== AC  =====', fg='green', style='negative'))
+
+    pipeline.pl_sandbox_clean(run)
+    return verdict, run.jail_report
+
+
+def _runSubtasks(pipeline, tasks, testfiles, cwd, short_circuit, *,
+                 order=None, parallel=1, cpus=None):
+    '''Run all `tasks` in `order`, a list of their indices, and yield the
+    (verdict, jail_report) of each of them in the original order. With
+    `parallel` > 1, up to that many tasks run at the same time, each pinned to
+    its own core from `cpus`.
+
+    Tasks decided to be skipped by `short_circuit` are not run and yielded as
+    (SKIPPED, None). In parallel the decision is made again in order, so the
+    results are the same as running serially.'''
+    if order is None:
+        order = range(len(tasks))
+
+    # hold results finished ahead of the original order
+    finished = {}
+    next_idx = 0
+    for task_idx, result in _runInOrder(pipeline, tasks, testfiles, cwd,
+                                        short_circuit, order, parallel, cpus):
+        finished[task_idx] = result
+        while next_idx in finished:
+            yield finished.pop(next_idx)
+            next_idx += 1
+
+
+def _runInOrder(pipeline, tasks, testfiles, cwd, short_circuit, order,
+                parallel, cpus):
+    '''Yield (task_idx, (verdict, jail_report)) of the tasks in `order`.'''
+    if cpus is None:
+        cpus = sorted(os.sched_getaffinity(0))
+    parallel = min(parallel, len(cpus))
+
+    def runOrSkip(task_idx, task):
+        if short_circuit.is_skipped(task_idx):
+            return SKIPPED_RESULT
+        verdict, jail_report = _runSubtask(
+            pipeline, task_idx, task, testfiles[task_idx], cwd)
+        short_circuit.record(task_idx, verdict)
+        return verdict, jail_report
+
+    if parallel <= 1:
+        for task_idx in order:
+            yield task_idx, runOrSkip(task_idx, tasks[task_idx])
+        return
+
+    free_cpus = queue.Queue()
+    for cpu in cpus:
+        free_cpus.put(cpu)
+
+    def runPinned(task_idx, task):
+        cpu = free_cpus.get()
+        try:
+            # affinity is per-thread, and the sandbox forked by this thread
+            # inherits it
+            os.sched_setaffinity(0, {cpu})
+            return runOrSkip(task_idx, task)
+        finally:
+            free_cpus.put(cpu)
+
+    logger.info('Running %d tasks with %d workers', len(tasks), parallel)
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [(task_idx, executor.submit(runPinned, task_idx, tasks[task_idx]))
+                   for task_idx in order]
+        for task_idx, future in futures:
+            result = future.result()
+            # every task before it has finished by now
+            if short_circuit.is_skipped(task_idx):
+                result = SKIPPED_RESULT
+            yield task_idx, result
+
+
+class PartialStatBatcher(object):
+    '''Batch the contexts of finished subtasks into partial_stat events, at
+    most one every `interval` seconds. Each event carries only the contexts
+    finished since the previous one.'''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = subtask_pb2.SubtaskContextList()
+        self.lastSent = time.monotonic()
+
+    def add(self, context):
+        '''Queue `context` and return an event if one is due, or None.'''
+        self.pending.values.append(context)
+        if time.monotonic() - self.lastSent < self.interval:
+            return None
+        return self.flush()
+
+    def flush(self):
+        if not self.pending.values:
+            return None
+        evt = iruka_rpc_pb2.SubmissionEvent(partial_stat=self.pending)
+        self.pending = subtask_pb2.SubtaskContextList()
+        self.lastSent = time.monotonic()
+        return evt
+
+
+def judgeSubmission(irukaClient, req, slot):
     # req:SubmissionRequest
     submission = req.submission
     # spec: list of Int64Array
@@ -32,8 +168,9 @@ def judgeSubmission(irukaClient, req):
 
     problem_id = submission.problem_id
 
-    if req.hoj_type != iruka_rpc_pb2.SubmissionRequest.REGULAR:
-        logger.warn('Only problems of type REGULAR are supported. Rejecting this request...')
+    if req.hoj_type not in (iruka_rpc_pb2.SubmissionRequest.REGULAR,
+                            iruka_rpc_pb2.SubmissionRequest.SPECIAL_JUDGE):
+        logger.warn('Only problems of type REGULAR or SPECIAL_JUDGE are supported. Rejecting this request...')
         yield iruka_rpc_pb2.SubmissionEvent(
             ack=iruka_rpc_pb2.SubmissionAck(
                 id=req.id,
@@ -52,7 +189,9 @@ def judgeSubmission(irukaClient, req):
     # pipeline.verifyTestdata()
     all_tasks = [t[1] for t in (spec.samples + spec.subtasks)]
     prob_testdata = Path(irukaClient.config.testdata_path) / str(problem_id)
-    testfiles, missing = hoj_helpers.hoj_collect_testdata(all_tasks, prob_testdata)
+    manifest = irukaClient.testdata_index.get(prob_testdata)
+    testfiles, missing = hoj_helpers.hoj_collect_testdata(
+        all_tasks, prob_testdata, manifest)
 
     if missing:
         # TODO: better error handling
@@ -64,173 +203,237 @@ def judgeSubmission(irukaClient, req):
         exc._missing = missing
         raise exc
 
-    log1 = open(LOG_STDOUT_PATH, 'w+')
-    log2 = open(LOG_STDERR_PATH, 'w+')
-
-    pipeline = JudgePipeline(
-        spec,
-        irukaClient.config,
-        nsjail_cfg_path=Path('./nsjail-configs/nsjail.cfg').absolute(),
-        log1=log1,
-        log2=log2)
-
-    # write out code; actually, gcc/g++ supports reading from stdin
-    PATH_USERCODE = '/run/shm/program.cpp'
-    PATH_PROGRAM = '/tmp/program'
-    with open(PATH_USERCODE, 'w') as f:
-        f.write(submission.code)
-        code_length = f.seek(0, os.SEEK_CUR)
-        logger.info('Written %d bytes to %s', code_length, PATH_USERCODE)
-
-    # compile
-    compile_ctx = {
-        'CFLAGS': '-DONLINE_JUDGE',
-    }
-    build_success = pipeline.pl_build(
-        src=Path(PATH_USERCODE).relative_to(pipeline.cwd_build),
-        output=PATH_PROGRAM,
-        context=compile_ctx)
-
-    if not build_success:
+    checker = irukaClient.checkers.resolve(problem_id, req.hoj_type, manifest)
+
+    cachedTestfiles = None
+    if irukaClient.testdata_cache is not None:
+        testfiles = cachedTestfiles = irukaClient.testdata_cache.bind(
+            problem_id, testfiles, manifest)
+
+    try:
+        workspace = slot.workspace
+
+        pipeline = JudgePipeline(
+            spec,
+            irukaClient.config,
+            nsjail_cfg_path=NSJAIL_CFG_PATH.absolute(),
+            build_cache=irukaClient.build_cache,
+            checker=checker,
+            sandboxes=slot.sandboxes,
+            workspace=workspace)
+
+        # write out code; actually, gcc/g++ supports reading from stdin
+        PATH_USERCODE = workspace / USERCODE_NAME
+        PATH_PROGRAM = workspace / PROGRAM_NAME
+        with open(PATH_USERCODE, 'w') as f:
+            f.write(submission.code)
+            code_length = f.seek(0, os.SEEK_CUR)
+            logger.info('Written %d bytes to %s', code_length, PATH_USERCODE)
+
+        # compile
+        compile_ctx = {
+            'CFLAGS': '-DONLINE_JUDGE',
+        }
+        build_success = pipeline.pl_build(
+            src=PATH_USERCODE.relative_to(pipeline.cwd_build),
+            output=PATH_PROGRAM,
+            context=compile_ctx)
+
+        if not build_success:
+            pipeline.finalize()
+            metrics.SUBMISSION_VERDICTS.inc(common_pb2.Verdict.Name(common_pb2.CE))
+            yield iruka_rpc_pb2.SubmissionEvent(
+                result=iruka_rpc_pb2.SubmissionResult(
+                    pipeline_success=False,
+                    final_stat=common_pb2.JudgeStat(
+                        verdict=common_pb2.CE
+                    ),
+                    code_length=code_length,
+                    log=pipeline.log_dict))
+            return
+
+        group_idx = 0
+        score_total = 0
+        final_verdict = common_pb2.AC
+
+        config = irukaClient.config
+        batcher = PartialStatBatcher(config.partial_stat_interval)
+        flat_tasks = [(tgid, st) for tgid, subtasks in pipeline.tasks for st in subtasks]
+        history = irukaClient.history
+        order = None
+        if history is not None and config.short_circuit:
+            # reach the failure deciding the result as early as possible
+            order = history.failure_order(problem_id, flat_tasks)
+            if cachedTestfiles is not None:
+                cachedTestfiles.reorder(order)
+        short_circuit = ShortCircuit(config.short_circuit, flat_tasks, order)
+        results = _runSubtasks(
+            pipeline, flat_tasks, testfiles, str(workspace), short_circuit,
+            order=order,
+            parallel=config.parallel_runs,
+            cpus=slot.cpus)
+        judged = []
+
+        for tgid, subtasks in pipeline.tasks:
+            is_judging_sample = (tgid == 0)
+
+            if is_judging_sample and len(subtasks):
+                logger.info(color('------ Start judge sample ------', style='bold'))
+            elif tgid == 1:
+                logger.info(color('------ Start judge real tasks ------', style='bold'))
+
+            score_group = 0
+
+            # begin of a task group
+            if not is_judging_sample:
+                _, score_group_max = spec.task_groups[group_idx]
+                score_group = score_group_max
+                logger.info('+++ Start of group #%d: score_max=%d', group_idx, score_group_max)
+
+            for gidx, subtask in subtasks:
+                verdict, jail_report = next(results)
+
+                # populate contexts
+                metrics.SUBTASK_VERDICTS.inc(common_pb2.Verdict.Name(verdict))
+                stat = common_pb2.JudgeStat(verdict=verdict)
+                if verdict == common_pb2.SKIPPED:
+                    logger.info('--- Task %d-%d: skipped', tgid, gidx)
+                else:
+                    stat.time_used = jail_report.time
+                    stat.mem_used = jail_report.memory
+                    judged.append((tgid, gidx, verdict, jail_report.time))
+                context = subtask_pb2.SubtaskContext(
+                    task_group_num=tgid,
+                    subtask_num=gidx,
+                    stat=stat)
+
+                # report progress as tasks finish
+                evt = batcher.add(context)
+                if evt is not None:
+                    yield evt
+
+                # FIXME!
+                # skipped tasks never decide the final verdict
+                if (verdict != common_pb2.SKIPPED
+                        and Verdict.from_proto_greater(verdict, final_verdict)):
+                    final_verdict = verdict
+
+                if verdict != common_pb2.AC and not subtask.fallthrough:
+                    score_group = 0
+
+            # end of a task group
+
+            if is_judging_sample:
+                # failing samples abort the real tasks with the "sample" policy of
+                # short_circuit
+                pass
+            else:
+                logger.info('[-] Group score: %d/%d', score_group, score_group_max)
+                # group grading
+                # FIXME: naive grading mechanism
+                score_total += score_group
+
+                group_idx += 1
+
+        # print('j1', pipeline.journals[0].dump_all())
+        # print('j2', pipeline.journals[1].dump_all())
+        evt = batcher.flush()
+        if evt is not None:
+            yield evt
+
         pipeline.finalize()
+        metrics.SUBMISSION_VERDICTS.inc(common_pb2.Verdict.Name(final_verdict))
+        if history is not None:
+            history.record(problem_id, judged)
+
+        # total grading (dummy)
+
         yield iruka_rpc_pb2.SubmissionEvent(
             result=iruka_rpc_pb2.SubmissionResult(
-                pipeline_success=False,
+                pipeline_success=True,
                 final_stat=common_pb2.JudgeStat(
-                    verdict=common_pb2.CE
+                    score=score_total,
+                    verdict=final_verdict,
                 ),
                 code_length=code_length,
                 log=pipeline.log_dict))
-        return
-
-    group_idx = 0
-    task_idx = 0
-    stat_list = subtask_pb2.SubtaskContextList()
-    score_total = 0
-    final_verdict = common_pb2.AC
-
-    for tgid, subtasks in pipeline.tasks:
-        is_judging_sample = (tgid == 0)
-
-        if is_judging_sample and len(subtasks):
-            logger.info(color('------ Start judge sample ------', style='bold'))
-        elif tgid == 1:
-            logger.info(color('------ Start judge real tasks ------', style='bold'))
-
-        score_group = 0
-
-        # begin of a task group
-        if not is_judging_sample:
-            _, score_group_max = spec.task_groups[group_idx]
-            score_group = score_group_max
-            logger.info('+++ Start of group #%d: score_max=%d', group_idx, score_group_max)
-
-        for indexed_subtask in subtasks:
-            gidx, subtask = indexed_subtask
-            logger.info('--- Task #%d, %d-%d: %r', task_idx, tgid, gidx, subtask)
-
-            infile_path = testfiles[task_idx][0]
-            subp = pipeline.pl_run(
-                indexed_subtask,
-                infile_path,
-                cwd='/tmp',
-                exec=['./program'])
-
-            # inspect jail_report to decide whether to skip checking
-            verdict = pipeline._determine_verdict(subtask.time_limit)
-
-            if verdict == 0:
-                checker_out = pipeline.pl_check(testfiles[task_idx])
-                verdict = checker_out.verdict
-                if verdict == common_pb2.WA:
-                    logger.info(color('===== WA  =====', fg='red', style='negative'))
-                else:
-                    logger.info(color('===== AC  =====', fg='green', style='negative'))
-
-            pipeline.pl_sandbox_clean()
-
-            # populate contexts
-            context = stat_list.values.add(
-                task_group_num=tgid,
-                subtask_num=gidx,
-                stat=common_pb2.JudgeStat(
-                    time_used=int(pipeline.jail_report['time']),
-                    mem_used=int(pipeline.jail_report['cgroup_memory_max_usage']),
-                    verdict=verdict))
-
-            # FIXME!
-            if Verdict.from_proto_greater(verdict, final_verdict):
-                final_verdict = verdict
-
-            if verdict != common_pb2.AC and not subtask.fallthrough:
-                score_group = 0
-
-            task_idx += 1
-
-        # end of a task group
-
-        if is_judging_sample:
-            # TODO: if internal error happens or pretest fail when testing "sample", abort
-            pass
-        else:
-            logger.info('[-] Group score: %d/%d', score_group, score_group_max)
-            # group grading
-            # FIXME: naive grading mechanism
-            score_total += score_group
-
-            group_idx += 1
-
-    # print('j1', pipeline.journals[0].dump_all())
-    # print('j2', pipeline.journals[1].dump_all())
-    yield iruka_rpc_pb2.SubmissionEvent(partial_stat=stat_list)
-
-    pipeline.finalize()
-
-    # total grading (dummy)
-
-    yield iruka_rpc_pb2.SubmissionEvent(
-        result=iruka_rpc_pb2.SubmissionResult(
-            pipeline_success=True,
-            final_stat=common_pb2.JudgeStat(
-                score=score_total,
-                verdict=final_verdict,
-            ),
-            code_length=code_length,
-            log=pipeline.log_dict))
-
-
-def requestJudge(irukaClient, submissionRequest):
-    logger.info('--- Server requested to judge %s ---',
-        pformat_pb(submissionRequest))
-
-    gen = judgeSubmission(irukaClient, submissionRequest)
-
-    def extract(iterable):
-        try:
-            yield from iterable
-        except IrukaInternalError as err:
-            logger.exception('Internal error happens when judging')
-
-            evt = iruka_rpc_pb2.SubmissionEvent(
-                exception=iruka_rpc_pb2.SubmissionException(
-                    message=str(err)))
-            yield evt
-        except Exception as err:
-            logger.exception('Unhandled exception when judging')
-
-            # should it dispose all previous result here?
-
-            buf = io.StringIO()
-            traceback.print_exc(file=buf)
-
-            msg = 'Uncaught exception occurs in client!\n{!s}\n{}'.format(
-                err, buf.getvalue())
-
-            evt = iruka_rpc_pb2.SubmissionEvent(
-                exception=iruka_rpc_pb2.SubmissionException(
-                    message=msg))
+    finally:
+        # the testdata of the problem may be evicted again
+        if cachedTestfiles is not None:
+            cachedTestfiles.close()
+
+
+def judgeEvents(irukaClient, submissionRequest, slot):
+    '''Judge the submission and yield the events to report. Errors are
+    reported as an exception event instead of being raised.'''
+    gen = profiling.profile_events(
+        irukaClient.config, submissionRequest,
+        judgeSubmission(irukaClient, submissionRequest, slot))
+
+    try:
+        yield from gen
+    except IrukaInternalError as err:
+        logger.exception('Internal error happens when judging')
+
+        evt = iruka_rpc_pb2.SubmissionEvent(
+            exception=iruka_rpc_pb2.SubmissionException(
+                message=str(err)))
+        yield evt
+    except Exception as err:
+        logger.exception('Unhandled exception when judging')
+
+        # should it dispose all previous result here?
+
+        buf = io.StringIO()
+        traceback.print_exc(file=buf)
+
+        msg = 'Uncaught exception occurs in client!\n{!s}\n{}'.format(
+            err, buf.getvalue())
+
+        evt = iruka_rpc_pb2.SubmissionEvent(
+            exception=iruka_rpc_pb2.SubmissionException(
+                message=msg))
+        yield evt
+
+
+def requestJudge(irukaClient, submissionRequest, slot, enqueuedAt=None):
+    logger.info('--- Server requested to judge %s on slot #%d ---',
+        pformat_pb(submissionRequest), slot.index)
+    if enqueuedAt is not None:
+        metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - enqueuedAt)
+
+    gen = judgeEvents(irukaClient, submissionRequest, slot)
+
+    # the events are recorded to be sent again if the connection is lost;
+    # gRPC pulls them from a thread of its own, hence the lock
+    events = []
+    lock = threading.Lock()
+    finishedAt = None
+
+    def record():
+        nonlocal finishedAt
+        while True:
+            with lock:
+                evt = next(gen, None)
+                if evt is None:
+                    finishedAt = time.monotonic()
+                    return
+                events.append(evt)
             yield evt
 
-    ret = irukaClient.stub.ReportSubmission(extract(gen))
+    try:
+        ret = irukaClient.stub.ReportSubmission(record())
+    except grpc.RpcError as err:
+        if err.code() != grpc.StatusCode.UNAVAILABLE:
+            raise
+        logger.warning('Connection lost while judging, continuing offline')
+        # finish judging anyway, and report it after reconnecting
+        with lock:
+            events.extend(gen)
+        irukaClient.deferReport(events)
+        return None
+
+    if finishedAt is not None:
+        metrics.REPORT_SECONDS.observe(time.monotonic() - finishedAt)
     logging.info('--- Judge completes, report sent ---')
     return ret
@@ -0,0 +1,102 @@
+'''A local store of how subtasks of each problem have been judged, to run the
+tasks most likely to fail first.
+
+For each (problem, task group, subtask) it keeps the number of runs, the number
+of failures and the total time used. It is keyed by the position of subtasks
+in the spec, so statistics of a problem whose testdata changed are stale until
+enough new submissions are judged; they only ever affect the order tasks run
+in, never the results.
+'''
+
+import logging
+import sqlite3
+import threading
+from itertools import groupby
+
+from iruka.protos import common_pb2
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subtask_stats (
+    problem_id INTEGER NOT NULL,
+    task_group INTEGER NOT NULL,
+    subtask INTEGER NOT NULL,
+    runs INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    time_total INTEGER NOT NULL,
+    PRIMARY KEY (problem_id, task_group, subtask)
+)
+'''
+
+
+class JudgeHistory(object):
+    '''Statistics of subtasks in an SQLite database at `path`. It may be shared
+    by the threads of all judge slots.'''
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(SCHEMA)
+
+    def record(self, problem_id, results):
+        '''Record `results`, a list of (tgid, gidx, verdict, time used) of the
+        tasks judged for a submission. Skipped tasks are left out.'''
+        rows = [
+            (problem_id, tgid, gidx,
+             0 if verdict == common_pb2.AC else 1, time_used)
+            for tgid, gidx, verdict, time_used in results
+            if verdict != common_pb2.SKIPPED]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany('''
+                INSERT INTO subtask_stats VALUES (?, ?, ?, 1, ?, ?)
+                ON CONFLICT (problem_id, task_group, subtask) DO UPDATE SET
+                    runs = runs + 1,
+                    failures = failures + excluded.failures,
+                    time_total = time_total + excluded.time_total
+            ''', rows)
+
+    def stats(self, problem_id):
+        '''Return {(tgid, gidx): (runs, failures, time_total)} of a problem.'''
+        with self._lock:
+            cur = self._conn.execute('''
+                SELECT task_group, subtask, runs, failures, time_total
+                FROM subtask_stats WHERE problem_id = ?
+            ''', (problem_id,))
+            return {(tgid, gidx): (runs, failures, time_total)
+                    for tgid, gidx, runs, failures, time_total in cur}
+
+    def failure_order(self, problem_id, tasks):
+        '''Return the order to run the flattened `tasks`, a list of
+        (tgid, (gidx, subtask)), as a list of their indices.
+
+        Task groups keep their order. Within a group, tasks are sorted by
+        their failure rate so far, the most likely to fail first, and among
+        equally likely ones the fastest first. Tasks never run are estimated
+        to take their time limit, and the order of a problem without any
+        history is unchanged.'''
+        stats = self.stats(problem_id)
+        if not stats:
+            return list(range(len(tasks)))
+
+        def priority(task_idx):
+            tgid, (gidx, subtask) = tasks[task_idx]
+            runs, failures, time_total = stats.get((tgid, gidx), (0, 0, 0))
+            # the failure rate with Laplace smoothing
+            p_fail = (failures + 1) / (runs + 2)
+            time_used = time_total / runs if runs else subtask.time_limit
+            return -p_fail, time_used
+
+        order = []
+        for _, group in groupby(range(len(tasks)), key=lambda i: tasks[i][0]):
+            order.extend(sorted(group, key=priority))
+        return order
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,140 @@
+'''Judge source files against a problem on the local machine, without the
+server, for rejudges and validating problems before contests.
+
+The submissions are judged by the judge slots of a client, exactly as they
+would be for the server, and the final event of each of them (a result or an
+exception) is written out in the order of the sources.
+'''
+
+import json
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import yaml
+from google.protobuf import json_format
+
+import iruka.handlers
+from iruka.checkers.registry import write_message
+from iruka.protos import (iruka_rpc_pb2, common_pb2)
+
+
+logger = logging.getLogger(__name__)
+
+SOURCE_SUFFIX = '.cpp'
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_PB = 'pb'
+
+
+def load_spec(path):
+    '''Load the spec in the tabular format of HOJ, a list of lists of integers
+    in a JSON or YAML file, as a list of Int64Array.'''
+    with open(path, 'r') as f:
+        rows = yaml.safe_load(f)
+    return [common_pb2.Int64Array(value=row) for row in rows]
+
+
+def collect_sources(paths):
+    '''Expand directories among `paths` to the source files in them.'''
+    sources = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            sources.extend(sorted(path.glob('*' + SOURCE_SUFFIX)))
+        else:
+            sources.append(path)
+    return sources
+
+
+def make_requests(sources, problem_id, spec, hoj_type):
+    return [
+        iruka_rpc_pb2.SubmissionRequest(
+            id=i + 1,
+            submission_id=i + 1,
+            submission=iruka_rpc_pb2.Submission(
+                problem_id=problem_id,
+                code=source.read_text()),
+            hoj_spec=spec,
+            hoj_type=hoj_type)
+        for i, source in enumerate(sources)]
+
+
+def judge_all(client, requests, on_event):
+    '''Judge `requests` with all slots of `client`, and call `on_event` with
+    the index of each request and its final event in the order of requests.'''
+    jobs = queue.Queue()
+    for i, req in enumerate(requests):
+        jobs.put((i, req))
+
+    finished = {}
+    next_idx = 0
+    lock = threading.Lock()
+
+    def worker(slot):
+        nonlocal next_idx
+        while True:
+            try:
+                i, req = jobs.get_nowait()
+            except queue.Empty:
+                return
+            last = None
+            for evt in iruka.handlers.judgeEvents(client, req, slot):
+                last = evt
+            with lock:
+                finished[i] = last
+                while next_idx in finished:
+                    on_event(next_idx, finished.pop(next_idx))
+                    next_idx += 1
+
+    workers = [
+        threading.Thread(target=worker, args=(slot,),
+                         name='slot{}'.format(slot.index))
+        for slot in client.slots]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def describe(evt):
+    '''The verdict of the final event of a judge, or why there is none.'''
+    kind = evt.WhichOneof('event')
+    if kind == 'result':
+        return common_pb2.Verdict.Name(evt.result.final_stat.verdict)
+    if kind == 'exception':
+        return 'exception'
+    if kind == 'ack':
+        return 'rejected'
+    return 'no result'
+
+
+def judge_local(client, sources, problem_id, spec, hoj_type, output, fmt):
+    '''Judge `sources` and write their results to the file `output`. Return
+    the number of submissions by their verdicts.'''
+    requests = make_requests(sources, problem_id, spec, hoj_type)
+    summary = Counter()
+
+    with open(output, 'wb') as f:
+        def on_event(i, evt):
+            summary[describe(evt)] += 1
+            logger.info('%s: %s', sources[i], describe(evt))
+            if fmt == FORMAT_PB:
+                write_message(f, evt)
+                return
+            record = {'source': str(sources[i])}
+            record.update(json_format.MessageToDict(evt))
+            f.write(json.dumps(record).encode() + b'\n')
+
+        start = time.monotonic()
+        judge_all(client, requests, on_event)
+        elapsed = time.monotonic() - start
+
+    print('judged {} submissions in {:.2f}s, {:.2f} submissions/s with {} workers'.format(
+        len(requests), elapsed, len(requests) / elapsed if elapsed else 0,
+        len(client.slots)))
+    for verdict, count in sorted(summary.items()):
+        print('  {:10} {}'.format(verdict, count))
+    return summary
@@ -0,0 +1,190 @@
+'''Metrics of the client in the text exposition format of Prometheus.
+
+Metrics are declared once at module level and updated in place; updating is a
+lock and a few additions, cheap enough to be always on. The registry is
+exposed on an HTTP port, or dumped to a file periodically, e.g. for the
+textfile collector of node_exporter.
+'''
+
+import bisect
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# in seconds; judging steps range from milliseconds to tens of seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 25, 60)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # the last one counts the values above all buckets
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+
+    def totals(self):
+        '''The number and the sum of observed values.'''
+        with self._lock:
+            return sum(self._counts), self._sum
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield (self.name + '_bucket',
+                   '{{le="{}"}}'.format(_format_value(bound)), cumulative)
+        yield self.name + '_sum', '', total
+        yield self.name + '_count', '', cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        '''Write the metrics to `path` atomically.'''
+        staging = '{}.{}.tmp'.format(path, os.getpid())
+        with open(staging, 'w') as f:
+            f.write(self.render())
+        os.replace(staging, path)
+
+
+REGISTRY = Registry()
+
+BUILD_SECONDS = REGISTRY.histogram(
+    'iruka_build_seconds', 'Time spent compiling submissions, excluding cache hits.')
+RUN_SECONDS = REGISTRY.histogram(
+    'iruka_run_seconds', 'Time spent running subtasks in the sandbox.')
+CHECK_SECONDS = REGISTRY.histogram(
+    'iruka_check_seconds', 'Time spent checking the output of subtasks.')
+REPORT_SECONDS = REGISTRY.histogram(
+    'iruka_report_seconds', 'Time from the last event of a report to its response.')
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'iruka_queue_wait_seconds', 'Time submissions wait for a free judge slot.')
+
+SUBTASK_VERDICTS = REGISTRY.counter(
+    'iruka_subtask_verdicts_total', 'Verdicts of subtasks.', ['verdict'])
+SUBMISSION_VERDICTS = REGISTRY.counter(
+    'iruka_submission_verdicts_total', 'Final verdicts of submissions.', ['verdict'])
+CACHE_HITS = REGISTRY.counter(
+    'iruka_cache_hits_total', 'Hits of local caches.', ['cache'])
+CACHE_MISSES = REGISTRY.counter(
+    'iruka_cache_misses_total', 'Misses of local caches.', ['cache'])
+
+
+def start_http_server(port, addr='127.0.0.1'):
+    '''Serve the metrics on `addr`:`port` from a daemon thread.'''
+    # imported here, as it is costly and metrics are served only optionally
+    from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on http://%s:%d/', addr, port)
+    return server
+
+
+def start_file_dumper(path, interval):
+    '''Dump the metrics to `path` every `interval` seconds from a daemon
+    thread.'''
+    stopped = threading.Event()
+
+    def dump():
+        while not stopped.wait(interval):
+            try:
+                REGISTRY.dump(path)
+            except OSError:
+                logger.warning('Failed to dump metrics to %s', path, exc_info=True)
+
+    thread = threading.Thread(target=dump, name='metrics-dump', daemon=True)
+    thread.start()
+    logger.info('Dumping metrics to %s every %ss', path, interval)
+    return stopped
@@ -1,20 +1,20 @@
-import importlib
 import logging
 import math
-import os
-import re
 import resource
 import shlex
 import subprocess
-import tempfile
 from pathlib import Path
 
 from colors import color
 
+from iruka.checkers.registry import (PythonChecker, DEFAULT_CHECKER)
+from iruka import metrics
 from iruka.common.utils import pformat
 from iruka.exceptions import IrukaInternalError
+from iruka.sandbox import (JailReport, SandboxPool, UserOutput)
 from iruka.utils.pipes import (_Popen, run_with_pipes, Journals)
 from iruka.utils.timer import Timer
+from iruka.utils.watchdog import TimeLimitWatchdog
 from iruka.protos import (iruka_rpc_pb2, subtask_pb2, checker_io_pb2, common_pb2)
 
 
@@ -22,21 +22,51 @@ def _ctx_quote_if_not_empty(context: dict):
     return { k: shlex.quote(v) if v else '' for k, v in context.items() }
 
 
+class SandboxRun(object):
+    '''State of a single run of a subtask in the sandbox. Runs are independent
+    of each other, so several of them may be in flight at the same time.'''
+    def __init__(self, subtask):
+        self.subtask = subtask
+        self.subp = None
+        self.user_temp = None
+        # set in streaming check mode
+        self.stream_diff = None
+        self.diff_at = None
+        self.jail_report = None
+        self.is_stdout_ole = False
+        self.is_time_exceeded = False
+        self.run_failed = False
+
+
 class JudgePipeline(object):
     def __init__(self, spec, config, *,
                  logger=None, log1=None, log2=None,
-                 nsjail_cfg_path):
+                 nsjail_cfg_path, build_cache=None, checker=None,
+                 sandboxes=None, workspace='/run/shm'):
         self.spec = spec
         self.nsjail_path = config.nsjail_path
         self.nsjail_cfg_path = nsjail_cfg_path
+        self.build_cache = build_cache
+        self.checker = checker
+        if checker is None:
+            self.checker = PythonChecker(DEFAULT_CHECKER)
+
+        self.sandboxes = sandboxes
+        if sandboxes is None:
+            self.sandboxes = SandboxPool(
+                self.nsjail_path, nsjail_cfg_path, config.parallel_runs)
 
-        self.cwd_build = Path('/run/shm')
+        self.cwd_build = Path(workspace)
 
         self.BUILD_OUT_LIM = 128 * 1024
         self.BUILD_MEM_LIM = 256 * 1024 * 1024
         self.RUN_OUT_LIM = 64 * 1024 * 1024
         self.USEROUT_PATH = '/run/shm/judge/out'
 
+        self.time_limit_grace = config.time_limit_grace
+        self.wall_time_ratio = config.wall_time_ratio
+        self.streaming_check = config.streaming_check
+
         # self.current_group = None
         # self.current_group_index = -1
         # self.current_subtask = None
@@ -58,15 +88,15 @@ class JudgePipeline(object):
 
         self.logger.debug('tasks %s', pformat(_tasks))
 
-        # prepare logging facilities
+        # prepare logging facilities; without log files, journals are kept
+        # in memory
         self.logfile_stdout = log1
         self.logfile_stderr = log2
-        self.journals = Journals(self.logfile_stdout, self.logfile_stderr)
+        if log1 is None and log2 is None:
+            self.journals = Journals.in_memory(2)
+        else:
+            self.journals = Journals(self.logfile_stdout, self.logfile_stderr)
 
-        self.user_temp = None
-        self._reset_state()
-
-    def __del__(self):
         self._reset_state()
 
     def pl_build(self, src, output, *, context: dict={}):
@@ -78,19 +108,46 @@ class JudgePipeline(object):
         compile_cmdline = cmdline_tpl.format(src=src, output=output, **context_quoted)
         compile_cmd = shlex.split(compile_cmdline)
 
+        cache_key = None
+        if self.build_cache is not None:
+            # the output path does not affect the result, so leave it out
+            # of the key to share entries between different destinations
+            key_cmd = shlex.split(cmdline_tpl.format(
+                src=src, output='{output}', **context_quoted))
+            with open(self.cwd_build / src, 'rb') as f:
+                code = f.read()
+            cache_key = self.build_cache.make_key(
+                code, key_cmd, compile_cmd[0], context)
+            entry = self.build_cache.lookup(cache_key)
+            if entry is not None:
+                try:
+                    entry.install(output)
+                except OSError:
+                    # evicted meanwhile or broken; build it again
+                    self.logger.warning('Cannot install cached build %s', cache_key,
+                        exc_info=True)
+                    self.build_cache.discard(cache_key)
+                    entry = None
+            if entry is not None:
+                self.logger.info('Using cached build %s', cache_key)
+                with self.journals.start('COMPILE') as (j1, j2):
+                    j1.write(entry.stdout.encode())
+                    j2.write(entry.stderr.encode())
+                self.build_ole_stdout = entry.ole_stdout
+                self.build_ole_stderr = entry.ole_stderr
+                return entry.success
+
         self.logger.info('Running command: %r', compile_cmd)
 
         # TODO: also confine the building process in the jail (should be chrooted)
-        def preexec():
-            lim = self.BUILD_MEM_LIM
-            resource.setrlimit(resource.RLIMIT_AS, (lim, lim))
+        lim = self.BUILD_MEM_LIM
 
         with Timer() as t:
             # Here we trust the compiler's output is well-formed
             with self.journals.start('COMPILE') as (j1, j2):
                 subp = run_with_pipes(compile_cmd,
                     cwd=self.cwd_build,
-                    preexec_fn=preexec,
+                    rlimits={resource.RLIMIT_AS: (lim, lim)},
                     universal_newlines=True,
                     pipe_stdout=(j1, self.BUILD_OUT_LIM),
                     pipe_stderr=(j2, self.BUILD_OUT_LIM))
@@ -101,73 +158,116 @@ class JudgePipeline(object):
             print(subp)
 
         self.logger.info("Build finished after %dms", t.duration * 1000)
+        metrics.BUILD_SECONDS.observe(t.duration)
+
+        if cache_key is not None:
+            self.build_cache.store(
+                cache_key,
+                success=(subp.returncode == 0),
+                output=output,
+                stdout=self.journals[0].dump('COMPILE'),
+                stderr=self.journals[1].dump('COMPILE'),
+                ole_stdout=self.build_ole_stdout,
+                ole_stderr=self.build_ole_stderr)
 
         return (subp.returncode == 0)
 
-    def pl_run(self, subtask, infile_path, *, cwd, exec, context:dict={}):
-        cmdline_args_tpl = (
-            '-C {nsjail_cfg_path} -D {cwd} '
-            '-t {time} --cgroup_mem_max {mem} --log_fd {log_fd} '
-            '{nsjail_args}')
-
-        log_file = tempfile.TemporaryFile()
-        log_fd = log_file.fileno()
-
+    def pl_run(self, subtask, infile_path, *, cwd, exec, outfile_path=None,
+               context:dict={}):
         gidx, task_spec = subtask
 
-        cmdline_args = cmdline_args_tpl.format(
-            cwd=shlex.quote(cwd),
-            time=math.ceil(task_spec.time_limit / 1000),
-            mem=task_spec.mem_limit * 1024,
-            nsjail_cfg_path=self.nsjail_cfg_path,
-            # log_file=log_file_path,
-            log_fd=log_fd,
-            nsjail_args=context.get('nsjail_args', ''))
-        run_cmd = [self.nsjail_path] + shlex.split(cmdline_args) + ['--'] + exec
-
-        self.user_temp = tempfile.NamedTemporaryFile(delete=False)
-        self.logger.info('Using temp %s', self.user_temp.name)
-
-        self.logger.info('Running command: %r', run_cmd)
-
-        with self.journals.start('RUN-{}'.format(task_spec.label)), \
-             open(infile_path, 'rb') as stdin, \
-             Timer() as t:
-            subp = run_with_pipes(run_cmd,
-                # check=True,
-                stdin=stdin,
-                pipe_stdout=(self.user_temp, self.RUN_OUT_LIM),
-                # if we believe user's stderr is not used AT ALL, the log
-                # can be passed with `--stderr_to_null` turned on in nsjail
-                stderr=subprocess.DEVNULL,
-                pass_fds=(log_fd,))
-            # to let it flush
-            self.user_temp.close()
-
-        self.logger.info("Run finished after %dms", t.duration * 1000)
-
-        self.is_stdout_ole = subp._ole_stdout
-        self.run_failed = (subp.returncode != 0)
-        with os.fdopen(log_fd, 'r') as nsjail_log:
-            self.jail_report = self._process_nsjail_log(nsjail_log)
-
-        return subp
-
-    def pl_check(self, test_files):
-        checker = importlib.import_module('iruka.checkers.tolerant_diff')
+        # limits in ms; the watchdog stops the program at the limit, while the
+        # limit of nsjail, which is in whole seconds, serves as a backstop
+        cpu_limit = task_spec.time_limit + self.time_limit_grace
+        wall_limit = task_spec.time_limit * self.wall_time_ratio + self.time_limit_grace
+        watchdog = TimeLimitWatchdog(cpu_limit / 1000, wall_limit / 1000)
+
+        run = SandboxRun(subtask)
+        if (self.streaming_check and outfile_path is not None
+                and self.checker.streamable):
+            # compare while running, and stop at the first differing line
+            run.stream_diff = self.checker.open_stream(outfile_path)
+            stdout_dest = run.stream_diff
+
+            def watch(process):
+                watchdog(process)
+                if run.stream_diff.diff_at is not None:
+                    watchdog.abort(process)
+        else:
+            run.user_temp = UserOutput()
+            self.logger.info('Using temp %s', run.user_temp.path)
+            stdout_dest = run.user_temp.file
+            watch = watchdog
+
+        with self.sandboxes.acquire() as sandbox:
+            run_cmd = sandbox.command(
+                exec,
+                cwd=cwd,
+                time_limit=math.ceil(wall_limit / 1000) + 1,
+                mem_limit=task_spec.mem_limit * 1024,
+                nsjail_args=context.get('nsjail_args', ''))
+            self.logger.info('Running command: %r', run_cmd)
+
+            with open(infile_path, 'rb') as stdin, Timer() as t:
+                subp = run_with_pipes(run_cmd,
+                    # check=True,
+                    stdin=stdin,
+                    pipe_stdout=(stdout_dest, self.RUN_OUT_LIM),
+                    # if we believe user's stderr is not used AT ALL, the log
+                    # can be passed with `--stderr_to_null` turned on in nsjail
+                    stderr=subprocess.DEVNULL,
+                    pass_fds=(sandbox.log_fd,),
+                    watchdog=watch)
+
+            self.logger.info("Run finished after %dms", t.duration * 1000)
+            metrics.RUN_SECONDS.observe(t.duration)
+
+            if run.stream_diff is not None:
+                run.diff_at = run.stream_diff.finish()
+            else:
+                # kept open until cleaned, or the memfd is gone
+                run.user_temp.file.flush()
+
+            run.subp = subp
+            run.is_stdout_ole = subp._ole_stdout
+            run.is_time_exceeded = watchdog.exceeded
+            run.run_failed = (subp.returncode != 0)
+            try:
+                run.jail_report = sandbox.report(subp._children_cpu_time)
+            except IrukaInternalError:
+                if not (watchdog.exceeded or watchdog.aborted):
+                    raise
+                # the watchdog stopped nsjail itself before it logged the
+                # statistics; the verdict is decided by the watchdog anyway
+                self.logger.warning('No statistics from the sandbox after it was stopped')
+                run.jail_report = JailReport.stopped(
+                    int(t.duration * 1000), subp._children_cpu_time)
+            self.logger.debug('Jail report: %r', run.jail_report)
+
+        return run
+
+    def pl_check(self, test_files, run):
         inf, outf = test_files
 
         checker_input = checker_io_pb2.CheckerInput(
             path_infile=str(inf),
             path_outfile=str(outf),
-            path_out_user=self.user_temp.name)
+            context=subtask_pb2.SubtaskContext())
+
+        if run.stream_diff is not None:
+            # already compared while running
+            return self.checker.stream_result(run.diff_at, checker_input)
 
-        checker_output = checker.main(checker_input)
+        checker_input.path_out_user = run.user_temp.path
+        with Timer() as t:
+            checker_output = self.checker.check(checker_input)
+        metrics.CHECK_SECONDS.observe(t.duration)
         return checker_output
 
-    def pl_sandbox_clean(self):
-        Path(self.user_temp.name).unlink()
-        self.user_temp = None
+    def pl_sandbox_clean(self, run):
+        if run.user_temp is not None:
+            run.user_temp.close()
+        run.user_temp = None
 
     def pl_grade(self):
         pass
@@ -189,56 +289,21 @@ class JudgePipeline(object):
         self.log_dict['COMPILE_STDERR'] = iruka_rpc_pb2.Log(
             content=self.journals[1].dump('COMPILE'),
             truncated=self.build_ole_stderr)
+        self.journals.close()
 
     def _reset_state(self):
-        # FIXME: is this a bad pattern?
-        if self.user_temp is not None:
-            self.user_temp.close()
-        self.user_temp = None
-        self.jail_report = None
         self.process_failed = False
-        self.is_stdout_ole = False
         self.log_dict = {}
 
-    def _process_nsjail_log(self, file):
-        jail_report = {}
-
-        for ln in file:
-            mat = re.match(r'\[S\]\[\d+?\] __STAT__:0 (?:\d+?:)?([\w]+)\s+=\s+(.*)', ln)
-            if mat is None:
-                # TODO: triage the message to separate file
-                # self.logger.debug('SANDBOX >>> %s', ln[:-1])
-                continue
-            jail_report[mat.group(1)] = mat.group(2)
-
-        self.logger.debug('captured stat dict:\n%s', pformat(jail_report))
-
-        mandatory_keys = [
-            'cgroup_memory_failcnt',
-            'cgroup_memory_max_usage',
-            'exit_normally',
-            'time'
-        ]
-
-        for k in mandatory_keys:
-            if k not in jail_report:
-                raise IrukaInternalError(
-                    'Cannot extract key "{}" from log, which is mandatory'.format(k))
-
-        return jail_report
-
-    def _determine_verdict(self, time_limit, print_fn=print) -> common_pb2.Verdict:
+    def _determine_verdict(self, run, time_limit, print_fn=print) -> common_pb2.Verdict:
         # Sadly, only time_limit is not exposed to any other sources
-        report = self.jail_report
-        time_used = int(report['time'])
-        mem_used = int(report['cgroup_memory_max_usage'])
-        is_seccomp_violating = (report.get('seccomp_violation', '') != 'false')
+        report = run.jail_report
 
-        if is_seccomp_violating:
+        if report.seccomp_violation:
             self.logger.info(color('===== RF =====', fg='yellow', style='negative'))
             return common_pb2.RF
 
-        if self.is_stdout_ole:
+        if run.is_stdout_ole:
             # looks like nsjail ignores SIGPIPE and let children continue to run
             # until TLE, because of the pid-namespace :(
             self.logger.info(color('===== OLE =====', style='negative'))
@@ -247,9 +312,15 @@ class JudgePipeline(object):
         # check if the process ends with error
         verdict = None
 
-        if report['cgroup_memory_failcnt'] != '0':
+        if report.memory_failcnt != 0:
             verdict = common_pb2.MLE
-        elif (report['exit_normally'] == 'false' and time_used >= time_limit):
+        elif run.is_time_exceeded:
+            verdict = common_pb2.TLE
+        elif (report.cpu_time is not None
+                and report.cpu_time > time_limit + self.time_limit_grace):
+            # over the limit, but finished before the watchdog noticed
+            verdict = common_pb2.TLE
+        elif (not report.exit_normally and report.time >= time_limit):
             # FIXME: task
             verdict = common_pb2.TLE
         elif self.process_failed:
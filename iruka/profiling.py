@@ -0,0 +1,133 @@
+'''Opt-in profiling of the client while it judges submissions, to tell where
+the time of a busy judge host goes.
+
+A profiler is attached to a fraction of submissions, and is active only while
+the thread driving the events of that submission runs judging code, so the
+time waiting for the server is left out. Threads spawned along the way, like
+the pipe relays of run_with_pipes, are not profiled.
+
+Two kinds are available:
+  - cprofile: deterministic, written as a .pstats file for pstats/snakeviz;
+    accurate call counts, but slows down Python code noticeably
+  - sampling: the stack of the judging thread is sampled every
+    profile_interval seconds, written as a .collapsed file for
+    flamegraph.pl/speedscope; the overhead is bounded by the interval
+'''
+
+import cProfile
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+class CProfiler(object):
+    SUFFIX = '.pstats'
+
+    def __init__(self, config):
+        self._profile = cProfile.Profile()
+
+    def enable(self):
+        self._profile.enable()
+
+    def disable(self):
+        self._profile.disable()
+
+    def dump(self, path):
+        self._profile.dump_stats(str(path))
+
+
+class SamplingProfiler(object):
+    SUFFIX = '.collapsed'
+
+    def __init__(self, config):
+        self.interval = config.profile_interval
+        self.counts = Counter()
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def enable(self):
+        self._thread_id = threading.get_ident()
+        if self._sampler is None:
+            self._sampler = threading.Thread(
+                target=self._sample, name='profiler', daemon=True)
+            self._sampler.start()
+
+    def disable(self):
+        self._thread_id = None
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            thread_id = self._thread_id
+            if thread_id is None:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                self.counts[self._collapse(frame)] += 1
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(
+                code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def dump(self, path):
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+PROFILERS = {
+    'cprofile': CProfiler,
+    'sampling': SamplingProfiler,
+}
+
+
+def validate_mode(mode):
+    if mode not in PROFILERS:
+        raise ValueError('Unknown profile mode "{}", should be one of {}'
+            .format(mode, ', '.join(PROFILERS)))
+
+
+def profile_events(config, req, gen):
+    '''Return `gen`, the events of judging `req`, profiled if profiling is on
+    and `req` is picked by profile_rate.'''
+    if not config.profile_path or random.random() >= config.profile_rate:
+        return gen
+    profiler = PROFILERS[config.profile_mode](config)
+    # rejudges of a submission keep their own profiles
+    path = Path(config.profile_path) / '{}-{}-{}{}'.format(
+        req.submission_id, req.id, time.strftime('%Y%m%d%H%M%S'),
+        profiler.SUFFIX)
+    return _profiled(gen, profiler, path)
+
+
+def _profiled(gen, profiler, path):
+    try:
+        while True:
+            profiler.enable()
+            try:
+                evt = next(gen, None)
+            finally:
+                profiler.disable()
+            if evt is None:
+                break
+            yield evt
+    finally:
+        gen.close()
+        profiler.dump(path)
+        logger.info('Profile written to %s', path)
@@ -0,0 +1,180 @@
+'''The state on our side of nsjail that is kept per judge slot and reused
+across runs: the file receiving the log of nsjail and the command line up to
+the arguments specific to a run.
+
+Nothing of nsjail itself is pre-warmed. It sets up the namespaces, mounts,
+seccomp policy and cgroup of every run, and tears them down when the program
+exits, so each run still pays for those; only the preparation in this
+process is saved.
+'''
+
+import contextlib
+import os
+import queue
+import shlex
+import tempfile
+
+from iruka.exceptions import IrukaInternalError
+
+
+# statistics are logged by nsjail as lines of
+#   [S][<pid>] __STAT__:0 [<n>:]<key> = <value>
+STAT_MARKER = '__STAT__:0 '
+
+MANDATORY_STATS = (
+    'cgroup_memory_failcnt',
+    'cgroup_memory_max_usage',
+    'exit_normally',
+    'time',
+)
+
+
+class JailReport(object):
+    '''Statistics of a run in the sandbox. Times are in milliseconds and
+    memory in bytes. `cpu_time` is None if the CPU time of the jailed program
+    is not available. The raw values are kept in `stats`.'''
+
+    __slots__ = ('time', 'cpu_time', 'memory', 'memory_failcnt',
+                 'exit_normally', 'seccomp_violation', 'stats')
+
+    def __init__(self, stats, jailed_cpu_time=None):
+        self.stats = stats
+        self.time = int(stats['time'])
+        self.memory = int(stats['cgroup_memory_max_usage'])
+        self.memory_failcnt = int(stats['cgroup_memory_failcnt'])
+        self.exit_normally = (stats['exit_normally'] != 'false')
+        self.seccomp_violation = (stats.get('seccomp_violation', '') != 'false')
+        self.cpu_time = None
+        if jailed_cpu_time is not None:
+            # in seconds, as accounted to nsjail for the children it reaped
+            self.cpu_time = int(jailed_cpu_time * 1000)
+
+    def __repr__(self):
+        return ('JailReport(time={}, cpu_time={}, memory={}, memory_failcnt={}, '
+                'exit_normally={}, seccomp_violation={})'.format(
+                    self.time, self.cpu_time, self.memory, self.memory_failcnt,
+                    self.exit_normally, self.seccomp_violation))
+
+    @classmethod
+    def parse(cls, log, jailed_cpu_time=None):
+        '''Extract the statistics from the log of nsjail.'''
+        stats = {}
+        for ln in log.splitlines():
+            pos = ln.find(STAT_MARKER)
+            if pos < 0:
+                continue
+            key, sep, value = ln[pos + len(STAT_MARKER):].partition(' = ')
+            if not sep:
+                continue
+            # drop the optional index
+            key = key.rpartition(':')[2].strip()
+            stats[key] = value.strip()
+
+        for k in MANDATORY_STATS:
+            if k not in stats:
+                raise IrukaInternalError(
+                    'Cannot extract key "{}" from log, which is mandatory'.format(k))
+
+        return cls(stats, jailed_cpu_time)
+
+    @classmethod
+    def stopped(cls, time, jailed_cpu_time=None):
+        '''The report of a run whose sandbox was stopped before logging its
+        statistics, after `time` ms.'''
+        return cls({
+            'time': str(time),
+            'cgroup_memory_max_usage': '0',
+            'cgroup_memory_failcnt': '0',
+            'exit_normally': 'false',
+            'seccomp_violation': 'false',
+        }, jailed_cpu_time)
+
+
+class UserOutput(object):
+    '''The output of a program, kept in an anonymous memfd where supported,
+    or a temporary file otherwise. Checkers, in this process or not, open it
+    by `path`. Closing it releases the storage.'''
+
+    def __init__(self):
+        memfd_create = getattr(os, 'memfd_create', None)
+        if memfd_create is not None:
+            self.file = open(memfd_create('user-output'), 'w+b')
+            # also valid in other processes of the same user
+            self.path = '/proc/{}/fd/{}'.format(os.getpid(), self.file.fileno())
+            self._temp = False
+        else:
+            self.file = tempfile.NamedTemporaryFile(delete=False)
+            self.path = self.file.name
+            self._temp = True
+
+    def close(self):
+        self.file.close()
+        if self._temp:
+            os.unlink(self.path)
+
+
+class Sandbox(object):
+    '''The log file and command line prefix of nsjail for one run at a time.'''
+
+    def __init__(self, nsjail_path, nsjail_cfg_path):
+        # inherited by nsjail as --log_fd, and truncated between runs
+        self.log_file = tempfile.TemporaryFile()
+        self.log_fd = self.log_file.fileno()
+        self.argv_prefix = [
+            str(nsjail_path),
+            '-C', str(nsjail_cfg_path),
+            '--log_fd', str(self.log_fd),
+        ]
+
+    def command(self, exec, *, cwd, time_limit, mem_limit, nsjail_args=''):
+        '''The command line to run `exec`, with `time_limit` in seconds and
+        `mem_limit` in bytes.'''
+        argv = self.argv_prefix + [
+            '-D', cwd,
+            '-t', str(time_limit),
+            '--cgroup_mem_max', str(mem_limit),
+        ]
+        if nsjail_args:
+            argv.extend(shlex.split(nsjail_args))
+        return argv + ['--'] + exec
+
+    def reset(self):
+        self.log_file.seek(0)
+        self.log_file.truncate()
+
+    def read_log(self):
+        self.log_file.seek(0)
+        return self.log_file.read().decode(errors='replace')
+
+    def report(self, jailed_cpu_time=None):
+        return JailReport.parse(self.read_log(), jailed_cpu_time)
+
+    def close(self):
+        self.log_file.close()
+
+
+class SandboxPool(object):
+    '''`size` sandboxes, one for each run that may happen at the same time.
+    Every run still spawns its own nsjail.'''
+
+    def __init__(self, nsjail_path, nsjail_cfg_path, size=1):
+        # the most recently used sandbox is handed out first, whose pages
+        # are more likely to be still cached
+        self._idle = queue.LifoQueue()
+        self._sandboxes = [Sandbox(nsjail_path, nsjail_cfg_path)
+                           for _ in range(size)]
+        for sandbox in self._sandboxes:
+            self._idle.put(sandbox)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        sandbox = self._idle.get()
+        try:
+            sandbox.reset()
+            yield sandbox
+        finally:
+            self._idle.put(sandbox)
+
+    def close(self):
+        for sandbox in self._sandboxes:
+            sandbox.close()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+'''Measure the throughput of relaying the output of a program to a file by
+run_with_pipes, with splice and with the copying loop.'''
+
+import argparse
+import os
+import tempfile
+import time
+
+from iruka.utils import pipes
+
+
+def relay(size, limit, directory=None):
+    cmd = ['head', '-c', str(size), '/dev/zero']
+    with tempfile.NamedTemporaryFile(dir=directory) as dest:
+        start = time.perf_counter()
+        before = os.times()
+        subp = pipes.run_with_pipes(cmd, pipe_stdout=(dest, limit))
+        after = os.times()
+        elapsed = time.perf_counter() - start
+    # CPU time spent in the judge itself, not in the program
+    cpu = (after.user - before.user) + (after.system - before.system)
+    return elapsed, cpu, subp._ole_stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256 * 1024 * 1024,
+        help='bytes written by the program')
+    parser.add_argument('--limit', type=int, default=64 * 1024 * 1024,
+        help='output limit, as RUN_OUT_LIM of the pipeline')
+    parser.add_argument('-n', type=int, default=5, help='number of runs')
+    parser.add_argument('--dir', help='where the destination file is created')
+    args = parser.parse_args()
+
+    splice = pipes._splice
+    modes = [('copy', None)]
+    if splice is not None:
+        modes.insert(0, ('splice', splice))
+    else:
+        print('os.splice is not available, only the copying loop is measured')
+
+    relayed = min(args.size, args.limit)
+    for name, fn in modes:
+        pipes._splice = fn
+        best, best_cpu = float('inf'), float('inf')
+        for _ in range(args.n):
+            elapsed, cpu, ole = relay(args.size, args.limit, args.dir)
+            best = min(best, elapsed)
+            best_cpu = min(best_cpu, cpu)
+        print('{:7} {:8.1f} MiB/s  judge CPU {:6.3f}s  OLE {}'.format(
+            name, relayed / best / 1024 / 1024, best_cpu, ole))
+    pipes._splice = splice
+
+
+if __name__ == '__main__':
+    main()
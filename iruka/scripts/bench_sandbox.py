@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+'''Compare the overhead of each run with the sandbox set up from scratch, as
+pl_run used to do, against a sandbox taken from a SandboxPool.
+
+By default only the preparation on our side is measured, which is all the pool
+saves. With --spawn, nsjail is also run with /bin/true, which needs nsjail and
+the cgroups set up by bin/cgroups_init.sh, to put the saving in proportion to
+the setup of nsjail that every run still pays for.
+'''
+
+import argparse
+import shlex
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from iruka.config import loadConfig
+from iruka.sandbox import SandboxPool
+
+
+NSJAIL_CFG_PATH = Path('./nsjail-configs/nsjail.cfg').absolute()
+CWD = '/tmp'
+EXEC = ['/bin/true']
+
+
+def run_fresh(config, spawn):
+    # the former setup in pl_run
+    cmdline_args_tpl = (
+        '-C {nsjail_cfg_path} -D {cwd} '
+        '-t {time} --cgroup_mem_max {mem} --log_fd {log_fd} '
+        '{nsjail_args}')
+    with tempfile.TemporaryFile() as log_file:
+        log_fd = log_file.fileno()
+        cmdline_args = cmdline_args_tpl.format(
+            cwd=shlex.quote(CWD), time=2, mem=64 * 1024 * 1024,
+            nsjail_cfg_path=NSJAIL_CFG_PATH, log_fd=log_fd, nsjail_args='')
+        run_cmd = [config.nsjail_path] + shlex.split(cmdline_args) + ['--'] + EXEC
+        if spawn:
+            subprocess.run(run_cmd, pass_fds=(log_fd,),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        log_file.seek(0)
+        return log_file.read()
+
+
+def run_pooled(pool, spawn):
+    with pool.acquire() as sandbox:
+        run_cmd = sandbox.command(
+            EXEC, cwd=CWD, time_limit=2, mem_limit=64 * 1024 * 1024)
+        if spawn:
+            subprocess.run(run_cmd, pass_fds=(sandbox.log_fd,),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return sandbox.read_log()
+
+
+def measure(fn, n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return statistics.mean(samples), samples[len(samples) // 2], samples[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=1000, help='number of runs')
+    parser.add_argument('--spawn', action='store_true', help='also run nsjail')
+    args = parser.parse_args()
+
+    config = loadConfig()
+    pool = SandboxPool(config.nsjail_path, NSJAIL_CFG_PATH)
+
+    for name, fn in (
+            ('fresh', lambda: run_fresh(config, args.spawn)),
+            ('pooled', lambda: run_pooled(pool, args.spawn))):
+        mean, p50, worst = measure(fn, args.n)
+        print('{:8} mean {:9.1f}us  p50 {:9.1f}us  max {:9.1f}us'.format(
+            name, mean * 1e6, p50 * 1e6, worst * 1e6))
+
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
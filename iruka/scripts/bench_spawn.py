@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+'''Measure the latency of launching a program with a memory limit by
+run_with_pipes, with setrlimit in a preexec_fn (which makes subprocess fork)
+and with the prlimit wrapper (which lets it vfork on Python 3.10+, and
+posix_spawn before that).'''
+
+import argparse
+import resource
+import statistics
+import time
+
+from iruka.utils import pipes
+
+
+def launch(rlimits, preexec_fn=None):
+    start = time.perf_counter()
+    pipes.run_with_pipes(['/bin/true'], rlimits=rlimits, preexec_fn=preexec_fn)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rss', type=int, default=0,
+        help='MiB of memory touched by the judge before launching, as if it had '
+             'grown with protobufs and journals')
+    parser.add_argument('-n', type=int, default=200, help='number of launches')
+    args = parser.parse_args()
+
+    ballast = bytearray(args.rss * 1024 * 1024)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    lim = 256 * 1024 * 1024
+    rlimits = {resource.RLIMIT_AS: (lim, lim)}
+
+    def noop():
+        pass
+
+    # any preexec_fn takes the fallback, as pl_build used to do
+    modes = [('preexec', noop)]
+    if pipes._which('prlimit') is not None:
+        modes.append(('prlimit', None))
+    else:
+        print('prlimit is not found, only the preexec_fn path is measured')
+
+    for name, preexec_fn in modes:
+        samples = [launch(rlimits, preexec_fn) for _ in range(args.n)]
+        print('{:8} mean {:7.3f}ms  p50 {:7.3f}ms  p99 {:7.3f}ms  (RSS +{} MiB)'.format(
+            name, statistics.mean(samples) * 1000,
+            statistics.median(samples) * 1000,
+            sorted(samples)[int(len(samples) * 0.99) - 1] * 1000, args.rss))
+
+
+if __name__ == '__main__':
+    main()
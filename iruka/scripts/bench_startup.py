@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''Measure the cold start of the entry points of the client, as the wall time
+of a fresh interpreter running each of them, and list the imports costing the
+most by python -X importtime.'''
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+
+Target = namedtuple('Target', ['name', 'args'])
+
+TARGETS = [
+    Target('client', ['-m', 'iruka', '--help']),
+    # prints the usage and exits without arguments
+    Target('checker', ['-m', 'iruka.checkers.tolerant_diff']),
+    Target('registry', ['-c', 'import iruka.checkers.registry']),
+    # what scripts/test_nsjail.py imports, without running nsjail
+    Target('test_nsjail', ['-c', 'import iruka.config, iruka.utils.pipes']),
+    Target('bare', ['-c', 'pass']),
+]
+
+
+def run(args, importtime=False):
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    start = time.perf_counter()
+    subp = subprocess.run(
+        cmd + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    return time.perf_counter() - start, subp
+
+
+def parse_importtime(stderr):
+    '''Return [(cumulative us, module)] of top-level imports, in the output
+    of -X importtime.'''
+    imports = []
+    for ln in stderr.decode(errors='replace').splitlines():
+        if not ln.startswith('import time:'):
+            continue
+        _, cumulative_us, name = ln.split('|')
+        # skips the header; nested imports are indented below their importer
+        if not cumulative_us.strip().isdigit() or name.startswith('  '):
+            continue
+        imports.append((int(cumulative_us), name.strip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=10, help='number of runs')
+    parser.add_argument('--top', type=int, default=8,
+        help='number of the most costly imports listed per target')
+    parser.add_argument('targets', nargs='*', help='targets to measure, '
+        'any of {}; default to all'.format(', '.join(t.name for t in TARGETS)))
+    args = parser.parse_args()
+
+    targets = [t for t in TARGETS if not args.targets or t.name in args.targets]
+    for target in targets:
+        samples = []
+        for _ in range(args.n):
+            elapsed, subp = run(target.args)
+            samples.append(elapsed)
+        print('{:12} min {:7.1f}ms  p50 {:7.1f}ms  exit {}'.format(
+            target.name, min(samples) * 1000,
+            statistics.median(samples) * 1000, subp.returncode))
+        if subp.returncode != 0 and subp.stderr.strip():
+            print('    ' + subp.stderr.decode(errors='replace').strip().splitlines()[-1])
+
+        _, subp = run(target.args, importtime=True)
+        imports = sorted(parse_importtime(subp.stderr), reverse=True)
+        for cumulative_us, name in imports[:args.top]:
+            print('    {:8.1f}ms  {}'.format(cumulative_us / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''Compare keeping the output of programs in a named temporary file, as
+pl_run used to do, against a memfd, over the whole life of the output: relay,
+check and clean up.'''
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from iruka.checkers.tolerant_diff import tolerant_diff_mapped
+from iruka.sandbox import UserOutput
+from iruka.utils.pipes import run_with_pipes
+
+
+def case_tempfile(cmd, expected):
+    user_temp = tempfile.NamedTemporaryFile(delete=False)
+    run_with_pipes(cmd, pipe_stdout=(user_temp, None))
+    user_temp.close()
+    result = tolerant_diff_mapped(user_temp.name, expected)
+    Path(user_temp.name).unlink()
+    return result
+
+
+def case_memfd(cmd, expected):
+    user_out = UserOutput()
+    run_with_pipes(cmd, pipe_stdout=(user_out.file, None))
+    user_out.file.flush()
+    result = tolerant_diff_mapped(user_out.path, expected)
+    user_out.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=16 * 1024 * 1024,
+        help='bytes of output of each case')
+    parser.add_argument('-n', type=int, default=20, help='number of cases')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        expected = os.path.join(root, 'expected')
+        with open(expected, 'wb') as f:
+            f.write(b'0123456789abcde\n' * (args.size // 16))
+        cmd = ['cat', expected]
+
+        for name, case in (('tempfile', case_tempfile), ('memfd', case_memfd)):
+            samples = []
+            for _ in range(args.n):
+                start = time.perf_counter()
+                assert case(cmd, expected) == -1
+                samples.append(time.perf_counter() - start)
+            print('{:9} mean {:8.2f}ms  p50 {:8.2f}ms  ({} KiB per case, temp dir {})'.format(
+                name, statistics.mean(samples) * 1000,
+                statistics.median(samples) * 1000,
+                args.size // 1024, tempfile.gettempdir()))
+
+
+if __name__ == '__main__':
+    main()
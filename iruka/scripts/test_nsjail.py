@@ -2,7 +2,7 @@
 import io
 import os
 
-from iruka.cli import (loadConfig)
+from iruka.config import loadConfig
 from iruka.utils.pipes import (_Popen, run_with_pipes)
 
 
@@ -0,0 +1,81 @@
+'''Policies to skip the remaining tasks of a submission once its result is
+already decided by some failure.
+'''
+
+import threading
+
+from iruka.protos import common_pb2
+
+
+# skip the rest of a task group after a non-fallthrough task fails
+SKIP_GROUP = 'group'
+# skip all real tasks after a sample fails
+SKIP_AFTER_SAMPLE = 'sample'
+# skip everything after the first failure
+SKIP_ALL = 'first'
+
+POLICIES = (SKIP_GROUP, SKIP_AFTER_SAMPLE, SKIP_ALL)
+
+
+def validate_policies(policies):
+    for policy in policies:
+        if policy not in POLICIES:
+            raise ValueError('Unknown short-circuit policy "{}", should be one of {}'
+                .format(policy, ', '.join(POLICIES)))
+
+
+class ShortCircuit(object):
+    '''Track the failures among the flattened `tasks`, a list of
+    (tgid, (gidx, subtask)), and decide which tasks are skipped.
+
+    `order` is the order the tasks are meant to run in, a list of their
+    indices, default to the spec order. A task is skipped iff some task before
+    it in this order has failed in a way that decides it under the policies.
+    Failures may be recorded in any order, so the decision for a task is final
+    once every task before it has been recorded, no matter in which order they
+    have actually run.'''
+
+    def __init__(self, policies, tasks, order=None):
+        validate_policies(policies)
+        self.policies = frozenset(policies)
+        self.tasks = tasks
+        if order is None:
+            order = range(len(tasks))
+        # position of each task in the order
+        self._position = {task_idx: pos for pos, task_idx in enumerate(order)}
+
+        self._failures = []
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.policies)
+
+    def record(self, task_idx, verdict):
+        if verdict in (common_pb2.AC, common_pb2.SKIPPED):
+            return
+        with self._lock:
+            self._failures.append(task_idx)
+
+    def is_skipped(self, task_idx):
+        if not self.policies:
+            return False
+        with self._lock:
+            failures = list(self._failures)
+        pos = self._position[task_idx]
+        return any(self._position[j] < pos and self._decides(j, task_idx)
+                   for j in failures)
+
+    def _decides(self, failed_idx, task_idx):
+        tgid_failed, (_, subtask_failed) = self.tasks[failed_idx]
+        tgid = self.tasks[task_idx][0]
+
+        if SKIP_ALL in self.policies:
+            return True
+        if SKIP_AFTER_SAMPLE in self.policies:
+            if tgid_failed == 0 and tgid != 0:
+                return True
+        if SKIP_GROUP in self.policies:
+            if (tgid_failed == tgid and tgid != 0
+                    and not subtask_failed.fallthrough):
+                return True
+        return False
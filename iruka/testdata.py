@@ -0,0 +1,305 @@
+'''Indexing and local caching of testdata, in front of testdata_path which may
+live on a slow network mount.
+
+A manifest lists the files of a problem with their sizes, mtimes and content
+hashes. It is built once and kept in memory until the directory changes.
+
+The cache copies files to a local directory, typically on tmpfs, the first
+time they are used, and problems are evicted as a whole in the order they were
+least recently used once the total size exceeds the bound.
+'''
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import (Counter, namedtuple)
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from iruka import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# an optional list of checksums in the format of sha256sum(1); if present,
+# files not matching their checksums are left out of the manifest
+CHECKSUMS_NAME = 'SHA256SUMS'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+ManifestEntry = namedtuple('ManifestEntry', [
+    'path', 'size', 'mtime_ns', 'digest'
+])
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_checksums(path):
+    checksums = {}
+    with open(path, 'r') as f:
+        for ln in f:
+            digest, _, name = ln.rstrip('\n').partition(' ')
+            # the name is prefixed by '*' in binary mode, or ' ' otherwise
+            checksums[name[1:]] = digest.lower()
+    return checksums
+
+
+class TestdataManifest(object):
+    '''The files of a problem directory. Use `name in manifest` to test the
+    existence of a usable file.'''
+
+    def __init__(self, prob_dir, mtime_ns, entries):
+        self.prob_dir = Path(prob_dir)
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.built_at = time.monotonic()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        return self.entries[name]
+
+    @classmethod
+    def build(cls, prob_dir, previous=None):
+        '''Scan `prob_dir`. Digests of files unchanged in size and mtime since
+        the `previous` manifest are reused instead of being hashed again.'''
+        prob_dir = Path(prob_dir)
+        mtime_ns = prob_dir.stat().st_mtime_ns
+        old_entries = previous.entries if previous is not None else {}
+
+        checksums = None
+        entries = {}
+        with os.scandir(str(prob_dir)) as it:
+            files = [e for e in it if e.is_file() and not e.name.startswith('.')]
+
+        for e in files:
+            if e.name == CHECKSUMS_NAME:
+                checksums = _read_checksums(e.path)
+                continue
+            st = e.stat()
+            old = old_entries.get(e.name)
+            if (old is not None and old.size == st.st_size
+                    and old.mtime_ns == st.st_mtime_ns):
+                digest = old.digest
+            else:
+                digest = _file_digest(e.path)
+            entries[e.name] = ManifestEntry(
+                Path(e.path), st.st_size, st.st_mtime_ns, digest)
+
+        if checksums is not None:
+            for name, entry in list(entries.items()):
+                expected = checksums.get(name)
+                if expected is not None and expected != entry.digest:
+                    logger.error('Testdata %s does not match its checksum', entry.path)
+                    del entries[name]
+
+        logger.debug('Built manifest of %s with %d files', prob_dir, len(entries))
+        return cls(prob_dir, mtime_ns, entries)
+
+
+class ManifestIndex(object):
+    '''Manifests of problems kept in memory. A manifest is rebuilt when the
+    mtime of its directory changes, or it is older than `ttl` seconds to catch
+    files modified in place. inotify is of no use here since it does not see
+    changes made by other hosts to a network mount.'''
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def get(self, prob_dir):
+        prob_dir = Path(prob_dir)
+        with self._lock:
+            manifest = self._manifests.get(prob_dir)
+
+        try:
+            mtime_ns = prob_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return TestdataManifest(prob_dir, None, {})
+
+        if manifest is not None and manifest.mtime_ns == mtime_ns and (
+                self.ttl is None
+                or time.monotonic() - manifest.built_at < self.ttl):
+            return manifest
+
+        manifest = TestdataManifest.build(prob_dir, previous=manifest)
+        with self._lock:
+            self._manifests[prob_dir] = manifest
+        return manifest
+
+
+def _dir_size(path):
+    size = 0
+    for f in path.iterdir():
+        try:
+            size += f.stat().st_size
+        except FileNotFoundError:
+            # renamed or removed in the meantime
+            pass
+    return size
+
+
+class TestdataCache(object):
+    def __init__(self, root, max_size):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # number of submissions using each problem directory, which are
+        # never evicted
+        self._holds = Counter()
+        self._prefetcher = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='prefetch')
+
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def bind(self, problem_id, testfiles, manifest=None):
+        '''Return the local copies of `testfiles` of a problem, which is held
+        until the returned CachedTestfiles is closed.'''
+        return CachedTestfiles(self, problem_id, testfiles, manifest)
+
+    def acquire(self, problem_id):
+        with self._lock:
+            self._holds[self.root / str(problem_id)] += 1
+
+    def release(self, problem_id):
+        prob_dir = self.root / str(problem_id)
+        with self._lock:
+            self._holds[prob_dir] -= 1
+            if self._holds[prob_dir] <= 0:
+                del self._holds[prob_dir]
+
+    def localize(self, problem_id, src, digest=None):
+        '''Return the path of the local copy of `src`, copying it if the copy
+        is absent or stale. With the `digest` of `src` from a manifest, copies
+        are told apart by content and the source is never looked at again;
+        otherwise a copy is stale if it differs from `src` in size or mtime.'''
+        src = Path(src)
+        prob_dir = self.root / str(problem_id)
+
+        if digest is not None:
+            dest = prob_dir / '{}.{}'.format(digest[:16], src.name)
+            fresh = dest.exists()
+        else:
+            dest = prob_dir / src.name
+            st_src = src.stat()
+            try:
+                st_dest = dest.stat()
+                fresh = (st_dest.st_size == st_src.st_size
+                         and st_dest.st_mtime_ns == st_src.st_mtime_ns)
+            except FileNotFoundError:
+                fresh = False
+
+        if fresh:
+            self.hits += 1
+            metrics.CACHE_HITS.inc('testdata')
+        else:
+            self.misses += 1
+            metrics.CACHE_MISSES.inc('testdata')
+            logger.debug('Copying testdata %s to cache', src)
+            prob_dir.mkdir(exist_ok=True)
+            # copy to a unique name first, so readers never see a partial file
+            staging = prob_dir / '.{}.{}'.format(src.name, threading.get_ident())
+            shutil.copy2(str(src), str(staging))
+            os.replace(str(staging), str(dest))
+            if digest is not None:
+                # drop the copies of former contents
+                for old in prob_dir.glob('*.' + src.name):
+                    if old != dest:
+                        old.unlink(missing_ok=True)
+            self.evict(keep=prob_dir)
+
+        # bump the problem as the most recently used
+        try:
+            os.utime(str(prob_dir))
+        except FileNotFoundError:
+            pass
+        return dest
+
+    def prefetch(self, problem_id, src, digest=None):
+        '''Localize `src` in the background.'''
+        def task():
+            try:
+                self.localize(problem_id, src, digest)
+            except OSError:
+                logger.warning('Failed to prefetch testdata %s', src, exc_info=True)
+        self._prefetcher.submit(task)
+
+    def evict(self, keep=None):
+        with self._lock:
+            entries = []
+            total = 0
+            for prob_dir in self.root.iterdir():
+                size = _dir_size(prob_dir)
+                entries.append((prob_dir.stat().st_mtime, size, prob_dir))
+                total += size
+
+            # least recently used first
+            entries.sort()
+            for _, size, prob_dir in entries:
+                if total <= self.max_size:
+                    break
+                if prob_dir == keep or prob_dir in self._holds:
+                    continue
+                logger.debug('Evicting testdata of problem %s', prob_dir.name)
+                shutil.rmtree(str(prob_dir), ignore_errors=True)
+                total -= size
+
+
+class CachedTestfiles(object):
+    '''A drop-in replacement of the list of (infile, outfile) paths returned by
+    hoj_collect_testdata, which serves local copies of them and prefetches the
+    input of the task to run next. Close it once the submission is judged.'''
+
+    def __init__(self, cache, problem_id, testfiles, manifest=None):
+        self.cache = cache
+        self.problem_id = problem_id
+        self.testfiles = testfiles
+        self.manifest = manifest
+
+        # tasks not asked for nor prefetched yet, in the order they run
+        self._upcoming = list(range(len(testfiles)))
+        self._lock = threading.Lock()
+        self._closed = False
+        cache.acquire(problem_id)
+
+    def __len__(self):
+        return len(self.testfiles)
+
+    def reorder(self, order):
+        '''Tell the order the tasks run in, as a list of their indices.'''
+        with self._lock:
+            self._upcoming = list(order)
+
+    def __getitem__(self, idx):
+        with self._lock:
+            if idx in self._upcoming:
+                self._upcoming.remove(idx)
+            upcoming = self._upcoming.pop(0) if self._upcoming else None
+        if upcoming is not None:
+            src = self.testfiles[upcoming][0]
+            self.cache.prefetch(self.problem_id, src, self._digest(src))
+        return tuple(self.cache.localize(self.problem_id, p, self._digest(p))
+                     for p in self.testfiles[idx])
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.cache.release(self.problem_id)
+
+    def _digest(self, path):
+        if self.manifest is None:
+            return None
+        return self.manifest[Path(path).name].digest
@@ -0,0 +1,22 @@
+import random
+
+
+class Backoff(object):
+    '''Exponentially growing delays between retries, from `initial` up to
+    `maximum` seconds. Each delay is randomly shortened by up to `jitter` of
+    itself so that clients restarted together do not retry in lockstep.'''
+
+    def __init__(self, initial, maximum, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * (2 ** self.attempts))
+        if delay < self.maximum:
+            self.attempts += 1
+        return delay * (1 - random.uniform(0, self.jitter))
@@ -6,11 +6,20 @@
 '''
 
 import contextlib
+import errno
+import fcntl
+import functools
 import io
+import mmap
 import os
 import queue
+import resource
 import selectors
+import shutil
+import stat
+import sys
 import subprocess
+import tempfile
 import threading
 from time import monotonic as _time
 
@@ -24,14 +33,160 @@ else:
 
 # default pipe buffer size is 16 pages
 PIPE_BUFFER_SIZE = 4096 * 16
+# in seconds
+WATCHDOG_INTERVAL = 0.01
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def _libc_splice():
+    '''splice(2) called through libc, with the signature of os.splice, which
+    is only there since Python 3.10. None if libc does not have it.'''
+    import ctypes
+
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).splice
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                   ctypes.c_size_t, ctypes.c_uint]
+    fn.restype = ctypes.c_ssize_t
+
+    def splice(src, dst, count):
+        while True:
+            n = fn(src, None, dst, None, count, 0)
+            if n >= 0:
+                return n
+            err = ctypes.get_errno()
+            # retried as os.splice does
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+    return splice
+
+
+# moves data from a pipe to a file within the kernel, on Linux
+_splice = getattr(os, 'splice', None) or _libc_splice()
+# pipes relayed by splice are enlarged to this size if permitted, to move more
+# in each call
+SPLICE_PIPE_SIZE = 1024 * 1024
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+# journals keep each tag in memory up to this size, and in a memfd beyond
+JOURNAL_SPILL_SIZE = 64 * 1024
+
+# options of prlimit(1) by resource
+_PRLIMIT_OPTIONS = {
+    resource.RLIMIT_AS: 'as',
+    resource.RLIMIT_CORE: 'core',
+    resource.RLIMIT_CPU: 'cpu',
+    resource.RLIMIT_DATA: 'data',
+    resource.RLIMIT_FSIZE: 'fsize',
+    resource.RLIMIT_NOFILE: 'nofile',
+    resource.RLIMIT_NPROC: 'nproc',
+    resource.RLIMIT_STACK: 'stack',
+}
+
+
+# without preexec_fn, subprocess launches with vfork since Python 3.10, and
+# with posix_spawn before that under the conditions in _spawnable, instead of
+# forking the whole judge, whose cost grows with its memory
+_HAS_VFORK = sys.version_info >= (3, 10)
+_HAS_POSIX_SPAWN = getattr(subprocess, '_USE_POSIX_SPAWN', False)
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    return shutil.which(name)
+
+
+def _format_rlimit(value):
+    return 'unlimited' if value == resource.RLIM_INFINITY else str(value)
+
+
+def _spawnable(kwargs):
+    '''Whether Popen with `kwargs` launches with posix_spawn before Python
+    3.10, once cwd and start_new_session are taken over by wrappers.'''
+    return (_HAS_POSIX_SPAWN
+            and not kwargs.get('pass_fds')
+            and (kwargs.get('cwd') is None or _which('env') is not None)
+            and (not kwargs.get('start_new_session') or _which('setsid') is not None))
+
+
+def _apply_rlimits(args, rlimits, kwargs):
+    '''Return the args to run `args` with `rlimits`, a dict of
+    resource -> (soft, hard), updating `kwargs` of Popen accordingly.
+
+    Where possible, the limits are set by exec'ing prlimit(1) in front of the
+    command instead of calling setrlimit in a preexec_fn, which would make
+    subprocess fork. Before Python 3.10, posix_spawn also needs close_fds
+    off (descriptors are not inheritable by default anyway), no cwd and no
+    start_new_session, so the latter two are done by exec'ing `env -C` and
+    setsid(1) as well. Otherwise the limits are set in a preexec_fn.'''
+    preexec_fn = kwargs.get('preexec_fn')
+    if not rlimits:
+        return args
+
+    prlimit = _which('prlimit')
+    if (prlimit is not None and preexec_fn is None
+            and all(r in _PRLIMIT_OPTIONS for r in rlimits)
+            and (_HAS_VFORK or _spawnable(kwargs))):
+        if isinstance(args, (str, bytes)):
+            args = [args]
+        wrappers = [prlimit] + [
+            '--{}={}:{}'.format(
+                _PRLIMIT_OPTIONS[r], _format_rlimit(soft), _format_rlimit(hard))
+            for r, (soft, hard) in rlimits.items()] + ['--']
+        if not _HAS_VFORK:
+            if kwargs.pop('start_new_session', False):
+                wrappers = [_which('setsid')] + wrappers
+            cwd = kwargs.pop('cwd', None)
+            if cwd is not None:
+                wrappers = [_which('env'), '-C', str(cwd)] + wrappers
+            kwargs['close_fds'] = False
+        return wrappers + list(args)
+
+    def preexec():
+        for r, limits in rlimits.items():
+            resource.setrlimit(r, limits)
+        if preexec_fn is not None:
+            preexec_fn()
+    kwargs['preexec_fn'] = preexec
+    return args
+
+
+def _children_cpu_time(pid):
+    '''CPU time in seconds of the reaped children of `pid`, which may have
+    exited but not been reaped itself yet.'''
+    try:
+        with open('/proc/{}/stat'.format(pid), 'r') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name may contain spaces; the fields start after it
+    fields = stat[stat.rindex(')') + 2:].split()
+    cutime, cstime = map(int, fields[13:15])
+    return (cutime + cstime) / _CLOCK_TICKS
 
 
 class _Popen(Popen):
-    def __init__(self, *args, pipe_stdout=None, pipe_stderr=None, **kwargs):
+    def __init__(self, args, *popenargs, pipe_stdout=None, pipe_stderr=None,
+                 watchdog=None, watchdog_interval=WATCHDOG_INTERVAL,
+                 rlimits=None, **kwargs):
         self.is_ole = [False] * 2
+        # resource usage of the process and its reaped descendants, once it
+        # has been waited for
+        self.rusage = None
+        # CPU time in seconds of the children reaped by the process, without
+        # its own, once it has been waited for; None if it is unknown
+        self.children_cpu_time = None
+        # called periodically with the process until it exits
+        self._watchdog = watchdog
+        self._watchdog_interval = watchdog_interval
         self._fd2dest = {}
         self._fd2limit = {}
         self._fd2length = {}
+        # destinations relayed to by splice, as file descriptors
+        self._fd2splice = {}
 
         if pipe_stdout is not None:
             if 'stdout' in kwargs:
@@ -44,7 +199,10 @@ class _Popen(Popen):
                     'piped and regular stderr may not both be used.')
             kwargs['stderr'] = subprocess.PIPE
 
-        super(_Popen, self).__init__(*args, **kwargs)
+        # resource limits of the child, see _apply_rlimits
+        args = _apply_rlimits(args, rlimits, kwargs)
+
+        super(_Popen, self).__init__(args, *popenargs, **kwargs)
 
         fd_out = self.stdout.fileno() if self.stdout else None
         fd_err = self.stderr.fileno() if self.stderr else None
@@ -57,6 +215,36 @@ class _Popen(Popen):
         if pipe_stderr is not None:
             self._fd2dest[fd_err], self._fd2limit[fd_err] = pipe_stderr
 
+        for fd, dest in self._fd2dest.items():
+            dest_fd = _splice_target(dest)
+            if dest_fd is not None:
+                self._fd2splice[fd] = dest_fd
+                try:
+                    fcntl.fcntl(fd, _F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+                except OSError:
+                    # beyond /proc/sys/fs/pipe-max-size
+                    pass
+
+    def _try_wait(self, wait_flags):
+        '''Like Popen._try_wait, but with wait4 to collect the resource
+        usage as well, and the CPU time of the children of the process
+        before it is reaped.'''
+        try:
+            if os.waitid(os.P_PID, self.pid,
+                         os.WEXITED | os.WNOWAIT | wait_flags) is not None:
+                self.children_cpu_time = _children_cpu_time(self.pid)
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # This happens if SIGCLD is set to be ignored or waiting
+            # for child processes has otherwise been disabled for our
+            # process.  This child is dead, we can't get the status.
+            pid = self.pid
+            sts = 0
+        else:
+            if pid == self.pid:
+                self.rusage = rusage
+        return (pid, sts)
+
     def communicate(self, input=None, timeout=None):
         '''Modified from CPython 3.6: subprocess.communicate
         '''
@@ -67,6 +255,7 @@ class _Popen(Popen):
         # started communicating, and we have one or zero pipes, using select()
         # or threads is unnecessary.
         if (timeout is None and not self._communication_started
+                and self._watchdog is None
                 and [self.stdin, self.stdout, self.stderr].count(None) >= 2):
             stdout = None
             stderr = None
@@ -159,8 +348,13 @@ class _Popen(Popen):
                 if timeout is not None and timeout < 0:
                     raise TimeoutExpired(self.args, orig_timeout)
 
+                if self._watchdog is not None:
+                    self._watchdog(self)
+                    if timeout is None or timeout > self._watchdog_interval:
+                        timeout = self._watchdog_interval
+
                 ready = selector.select(timeout)
-                self._check_timeout(endtime, orig_timeout)
+                self._check_deadline(endtime, orig_timeout)
 
                 # XXX Rewrite these to use non-blocking I/O on the file
                 # objects; they are no longer using C stdio!
@@ -195,6 +389,17 @@ class _Popen(Popen):
                                 key.fileobj.close()
                             self._fd2output[key.fileobj].append(data)
 
+        # the process may keep running after closing its pipes
+        if self._watchdog is not None:
+            # reap only through wait(), which collects the resource usage
+            while self.returncode is None:
+                self._check_deadline(endtime, orig_timeout)
+                self._watchdog(self)
+                try:
+                    self.wait(timeout=self._watchdog_interval)
+                except TimeoutExpired:
+                    pass
+
         self.wait(timeout=self._remaining_time(endtime))
 
         # All data exchanged.  Translate lists into strings.
@@ -215,6 +420,11 @@ class _Popen(Popen):
 
         return (stdout, stderr)
 
+    def _check_deadline(self, endtime, orig_timeout):
+        # Popen._check_timeout takes extra arguments since Python 3.7
+        if endtime is not None and _time() > endtime:
+            raise TimeoutExpired(self.args, orig_timeout)
+
     @property
     def _text_mode(self):
         try:
@@ -243,21 +453,39 @@ class _Popen(Popen):
         dest = self._fd2dest[fd]
         limit = self._fd2limit[fd]
         length_read = self._fd2length[fd]
+        if fd in self._fd2splice:
+            buffer_size = SPLICE_PIPE_SIZE
 
         if limit is None or limit < 0:
             sz = buffer_size
         else:
             sz = min(buffer_size, limit - length_read)
 
+        if sz == 0:
+            if os.read(fd, 1):
+                # read returning, meaning not EOF yet,
+                # which means exceeding the max_size limit
+                return -1
+            return 0
+
+        dest_fd = self._fd2splice.get(fd)
+        if dest_fd is not None:
+            try:
+                szr = _splice(fd, dest_fd, sz)
+            except OSError as err:
+                if err.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                # not supported by the file system; copy from now on
+                del self._fd2splice[fd]
+            else:
+                self._fd2length[fd] += szr
+                return szr
+
         buf = os.read(fd, sz)
         # print(f'sync ({sz}/{limit}): [{buf}], rem {limit - length_read}')
 
-        if sz != 0 and not buf:  # EOF
+        if not buf:  # EOF
             return 0
-        if sz == 0 and os.read(fd, 1):
-            # read returning, meaning not EOF yet,
-            # which means exceeding the max_size limit
-            return -1
         szr = len(buf)
         self._fd2length[fd] += szr
 
@@ -265,6 +493,23 @@ class _Popen(Popen):
         return szr
 
 
+def _splice_target(dest):
+    '''The file descriptor of `dest` if output to it can be spliced, i.e.
+    `dest` is a regular file, otherwise None.'''
+    if _splice is None:
+        return None
+    try:
+        fd = dest.fileno()
+    except (AttributeError, OSError, ValueError):
+        # e.g. in-memory streams
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    # anything buffered has to land before the spliced data
+    dest.flush()
+    return fd
+
+
 def run_with_pipes(*popenargs, input=None, timeout=None, check=False,
                    **kwargs):
     '''Only replace _Popen with the above implementation. The logic is the same
@@ -294,6 +539,8 @@ def run_with_pipes(*popenargs, input=None, timeout=None, check=False,
     # to include OLE information
     ret = CompletedProcess(process.args, retcode, stdout,
                             stderr)
+    ret._rusage = process.rusage
+    ret._children_cpu_time = process.children_cpu_time
     ole1, ole2 = process.is_ole
     ret._ole_stdout = ole1
     ret._ole_stderr = ole2
@@ -375,13 +622,138 @@ class JournalPipe(object):
         return buf
 
 
+class _TagBuffer(object):
+    '''The content of a tag, in memory up to `spill_size` bytes, and in an
+    anonymous file beyond.'''
+
+    def __init__(self, spill_size):
+        self.spill_size = spill_size
+        self.length = 0
+        self._buf = bytearray()
+        self._file = None
+        self._map = None
+
+    def write(self, data):
+        if self._file is None and len(self._buf) + len(data) > self.spill_size:
+            self._spill()
+        if self._file is None:
+            self._buf += data
+        else:
+            self._file.write(data)
+            self._map = None
+        self.length += len(data)
+
+    def view(self):
+        if self._file is None:
+            return memoryview(self._buf)
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(
+                self._file.fileno(), self.length, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._map = None
+        self._buf = bytearray()
+
+    def _spill(self):
+        memfd_create = getattr(os, 'memfd_create', None)
+        if memfd_create is not None:
+            self._file = open(memfd_create('journal'), 'w+b')
+        else:
+            self._file = tempfile.TemporaryFile()
+        self._file.write(self._buf)
+        self._buf = bytearray()
+
+
+class MemoryJournalPipe(object):
+    '''A JournalPipe keeping the content of each tag in a buffer of its own
+    instead of regions of a shared file. Output written while no tag is
+    active is discarded.'''
+
+    def __init__(self, text_mode=True, spill_size=JOURNAL_SPILL_SIZE):
+        self.text_mode = text_mode
+        self.spill_size = spill_size
+        self.active = False
+
+        # str -> _TagBuffer
+        self.tag_map = {}
+        self._active_tag = None
+        self._active_buf = None
+
+    def mark(self, tag):
+        if self._active_tag is not None:
+            # consider replacing it with a lock
+            raise Exception('Pipe is still in use. Call JournalPipe.mark_end()'
+                            + ' first before starting another task.')
+        if tag is None:
+            raise ValueError('No tag is specified.')
+
+        self._active_tag = tag
+        self._active_buf = _TagBuffer(self.spill_size)
+        self.active = True
+
+    def mark_end(self):
+        if not self._active_tag:
+            raise Exception('No active tag to mark_end.')
+        old = self.tag_map.get(self._active_tag)
+        if old is not None:
+            old.close()
+        self.tag_map[self._active_tag] = self._active_buf
+        self._active_tag = None
+        self._active_buf = None
+        self.active = False
+
+    def write(self, buf):
+        if self._active_buf is not None:
+            self._active_buf.write(buf)
+
+    def view(self, tag):
+        '''The content of `tag` as a memoryview of bytes, valid until the tag
+        is written again.'''
+        tag_buf = self.tag_map.get(tag, None)
+        if tag_buf is None:
+            raise ValueError('Undefined tag "{}"'.format(tag))
+        return tag_buf.view()
+
+    def dump(self, tag):
+        buf = self.view(tag)
+        if self.text_mode:
+            return str(buf, errors='replace')
+        return bytes(buf)
+
+    def dump_all(self):
+        return [(name, self.dump(name)) for name in self.tag_map]
+
+    def close(self):
+        for tag_buf in self.tag_map.values():
+            tag_buf.close()
+        self.tag_map = {}
+
+
 class Journals(object):
     def __init__(self, *files):
         self._journals = tuple(map(JournalPipe, files))
 
+    @classmethod
+    def in_memory(cls, count=2, spill_size=JOURNAL_SPILL_SIZE):
+        '''Journals backed by memory instead of files.'''
+        journals = cls()
+        journals._journals = tuple(
+            MemoryJournalPipe(spill_size=spill_size) for _ in range(count))
+        return journals
+
     def __getitem__(self, idx):
         return self._journals[idx]
 
+    def close(self):
+        for j in self._journals:
+            if isinstance(j, MemoryJournalPipe):
+                j.close()
+
     def mark(self, *tags):
         for j, tag in zip(self._journals, tags):
             if tag:
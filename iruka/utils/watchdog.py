@@ -0,0 +1,119 @@
+'''Enforce time limits with a finer granularity than nsjail, whose limit is in
+whole seconds. Meant to be passed as the `watchdog` of `_Popen`, which calls
+it periodically until the process exits.
+'''
+
+import logging
+import os
+import signal
+import time
+from time import monotonic as _time
+
+
+logger = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# times to look for the jailed process before stopping the sandbox instead,
+# which may exit before logging its statistics
+KILL_LOOKUP_ATTEMPTS = 5
+KILL_LOOKUP_DELAY = 0.01
+
+
+def _proc_children(pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid), 'r') as f:
+            return [int(x) for x in f.read().split()]
+    except OSError:
+        return []
+
+
+def _proc_cpu_time(pid):
+    '''CPU time in seconds consumed by `pid` and its reaped children.'''
+    with open('/proc/{}/stat'.format(pid), 'r') as f:
+        stat = f.read()
+    # the command name may contain spaces; the fields start after it
+    fields = stat[stat.rindex(')') + 2:].split()
+    utime, stime, cutime, cstime = map(int, fields[11:15])
+    return (utime + stime + cutime + cstime) / CLOCK_TICKS
+
+
+class TimeLimitWatchdog(object):
+    '''Kill the process run by the sandbox once its CPU time exceeds
+    `cpu_limit`, or the wall time since the first call exceeds `wall_limit`.
+    Both limits are in seconds.
+
+    The process watched is the child of the sandbox (nsjail) itself. If it
+    cannot be found through procfs, only the wall time is enforced, by stopping
+    the sandbox instead.'''
+
+    def __init__(self, cpu_limit, wall_limit):
+        self.cpu_limit = cpu_limit
+        self.wall_limit = wall_limit
+        self.exceeded = False
+        self.aborted = False
+
+        self._start_time = None
+        self._jailed_pid = None
+
+    def __call__(self, process):
+        if self.exceeded or self.aborted:
+            return
+        now = _time()
+        if self._start_time is None:
+            self._start_time = now
+
+        if self._jailed_pid is None:
+            children = _proc_children(process.pid)
+            if children:
+                self._jailed_pid = children[0]
+
+        cpu_time = None
+        if self._jailed_pid is not None:
+            try:
+                cpu_time = _proc_cpu_time(self._jailed_pid)
+            except (OSError, ValueError):
+                # exited in the meantime; looked up again next time, and the
+                # wall time is still enforced
+                self._jailed_pid = None
+
+        if cpu_time is not None and cpu_time > self.cpu_limit:
+            logger.debug('CPU time limit exceeded (%.3fs)', cpu_time)
+        elif now - self._start_time > self.wall_limit:
+            logger.debug('Wall time limit exceeded (%.3fs)', now - self._start_time)
+        else:
+            return
+
+        self.exceeded = True
+        self._kill(process)
+
+    def abort(self, process):
+        '''Stop the process early for reasons other than the time limits.'''
+        if self.exceeded or self.aborted:
+            return
+        self.aborted = True
+        self._kill(process)
+
+    def _kill(self, process):
+        # the jailed process may not have been found yet
+        for attempt in range(KILL_LOOKUP_ATTEMPTS):
+            if self._jailed_pid is not None or process.returncode is not None:
+                break
+            if attempt:
+                time.sleep(KILL_LOOKUP_DELAY)
+            children = _proc_children(process.pid)
+            if children:
+                self._jailed_pid = children[0]
+
+        if self._jailed_pid is not None:
+            try:
+                # the sandbox reaps it and reports as usual
+                os.kill(self._jailed_pid, signal.SIGKILL)
+                return
+            except ProcessLookupError:
+                return
+            except PermissionError:
+                logger.warning('Not permitted to kill the jailed process %d',
+                    self._jailed_pid)
+        # nsjail kills its children when terminated
+        process.terminate()
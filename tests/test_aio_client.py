@@ -0,0 +1,92 @@
+'''Drive the asyncio client against the stand-in server of iruka.bench.'''
+
+import asyncio
+
+import pytest
+
+grpc = pytest.importorskip('grpc')
+
+import iruka.handlers
+from iruka.aio_client import AsyncIrukaClient
+from iruka.bench.server import (FakeIrukaServer, serve)
+from iruka.config import Config
+from iruka.protos import (iruka_rpc_pb2, common_pb2)
+
+
+AUTH_TOKEN = 'test'
+
+
+def make_config(port, tmp_path):
+    config = Config()
+    config.server = '127.0.0.1:{}'.format(port)
+    config.auth_token = AUTH_TOKEN
+    config.use_https = False
+    config.use_asyncio = True
+    config.reconnect = False
+    config.nsjail_path = '/bin/true'
+    config.testdata_path = str(tmp_path)
+    config.workspace_path = str(tmp_path / 'judge')
+    return config
+
+
+def fake_judge_events(irukaClient, req, slot):
+    yield iruka_rpc_pb2.SubmissionEvent(
+        ack=iruka_rpc_pb2.SubmissionAck(id=req.id))
+    yield iruka_rpc_pb2.SubmissionEvent(
+        result=iruka_rpc_pb2.SubmissionResult(
+            pipeline_success=True,
+            final_stat=common_pb2.JudgeStat(verdict=common_pb2.AC)))
+
+
+def test_auth_and_judge(tmp_path, monkeypatch):
+    monkeypatch.setattr(iruka.handlers, 'judgeEvents', fake_judge_events)
+
+    req = iruka_rpc_pb2.SubmissionRequest(id=1, submission_id=1)
+    servicer = FakeIrukaServer([req], AUTH_TOKEN)
+    server, port = serve(servicer)
+    try:
+        client = AsyncIrukaClient(make_config(port, tmp_path))
+        assert client.connect() != False
+    finally:
+        server.stop(None)
+
+    record = servicer.records[1]
+    assert record.exception is None
+    assert record.result.final_stat.verdict == common_pb2.AC
+    assert servicer.finished.is_set()
+
+
+class FailingStub(object):
+    '''Takes the first event of a report, then fails it.'''
+
+    async def ReportSubmission(self, requests):
+        async for evt in requests:
+            raise grpc.aio.AioRpcError(
+                grpc.StatusCode.INTERNAL,
+                grpc.aio.Metadata(), grpc.aio.Metadata())
+
+
+def test_failed_report_stops_judging(tmp_path, monkeypatch):
+    steps = []
+
+    def endless_judge_events(irukaClient, req, slot):
+        try:
+            while True:
+                steps.append(len(steps))
+                yield iruka_rpc_pb2.SubmissionEvent(
+                    ack=iruka_rpc_pb2.SubmissionAck(id=req.id))
+        finally:
+            steps.append('closed')
+
+    monkeypatch.setattr(iruka.handlers, 'judgeEvents', endless_judge_events)
+
+    client = AsyncIrukaClient(make_config(0, tmp_path))
+    client.stub = FailingStub()
+    req = iruka_rpc_pb2.SubmissionRequest(id=1, submission_id=1)
+    try:
+        with pytest.raises(grpc.RpcError):
+            asyncio.run(client._judge(req, client.slots[0]))
+    finally:
+        for executor in client.executors.values():
+            executor.shutdown()
+    assert steps[-1] == 'closed'
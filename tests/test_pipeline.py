@@ -0,0 +1,46 @@
+'''Verdicts decided from the report of the sandbox.'''
+
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('google.protobuf')
+pytest.importorskip('colors')
+
+from iruka.pipeline import (JudgePipeline, SandboxRun)
+from iruka.protos import common_pb2
+from iruka.sandbox import JailReport
+
+
+TIME_LIMIT = 1000
+GRACE = 50
+
+
+def determine_verdict(time_used, jailed_cpu_time):
+    pipeline = SimpleNamespace(
+        logger=logging.getLogger(__name__),
+        time_limit_grace=GRACE,
+        process_failed=False)
+    run = SandboxRun(None)
+    run.jail_report = JailReport({
+        'time': str(time_used),
+        'cgroup_memory_max_usage': '0',
+        'cgroup_memory_failcnt': '0',
+        'exit_normally': 'true',
+        'seccomp_violation': 'false',
+    }, jailed_cpu_time)
+    return JudgePipeline._determine_verdict(pipeline, run, TIME_LIMIT)
+
+
+def test_at_limit_stays_accepted():
+    assert determine_verdict(TIME_LIMIT, TIME_LIMIT / 1000) == common_pb2.PENDING
+
+
+def test_unknown_cpu_time_is_accepted():
+    assert determine_verdict(TIME_LIMIT, None) == common_pb2.PENDING
+
+
+def test_over_limit_and_grace_is_tle():
+    cpu_time = (TIME_LIMIT + GRACE + 10) / 1000
+    assert determine_verdict(TIME_LIMIT, cpu_time) == common_pb2.TLE
@@ -0,0 +1,28 @@
+'''Resource accounting of run_with_pipes.'''
+
+import sys
+
+from iruka.utils.pipes import run_with_pipes
+
+
+BURN = '''
+import time
+end = time.process_time() + {}
+while time.process_time() < end:
+    pass
+'''
+
+# burns CPU time in a child, then as much again by itself, like nsjail would
+# if it were slow
+PARENT = '''
+import subprocess, sys
+subprocess.run([sys.executable, '-c', {!r}], check=True)
+''' + BURN
+
+
+def test_children_cpu_time_excludes_the_process_itself():
+    subp = run_with_pipes(
+        [sys.executable, '-c', PARENT.format(BURN.format(0.3), 0.3)])
+    assert subp.returncode == 0
+    total = subp._rusage.ru_utime + subp._rusage.ru_stime
+    assert 0.3 <= subp._children_cpu_time < total - 0.25
@@ -0,0 +1,77 @@
+'''The bulk and streaming engines of tolerant_diff against the reference
+tolerant_diff_at, which compares files line by line in text mode.'''
+
+import pytest
+
+pytest.importorskip('google.protobuf')
+
+from iruka.checkers import tolerant_diff
+from iruka.checkers.tolerant_diff import (
+    StreamingDiff, _diff_buffers, tolerant_diff_at, tolerant_diff_mapped)
+
+
+# (user output, expected output)
+CASES = [
+    (b'', b''),
+    (b'', b'\n'),
+    (b'\n', b''),
+    (b'1\n2\n', b'1\n2\n'),
+    (b'1\r\n2\r\n', b'1\n2\n'),
+    (b'1\r2\r', b'1\n2\n'),
+    (b'1\r\n2\r\n', b'1\r2\r'),
+    (b'1\n2', b'1\n2\n'),
+    (b'1\n2\r', b'1\n2'),
+    (b'1\n2\n\n', b'1\n2\n'),
+    (b'1\n3', b'1\n2\n'),
+    (b'  1 \t\n2\x0b\x0c\n', b'1\n2\n'),
+    ('1\u3000\n 2\n'.encode(), b'1\n2\n'),
+    ('é 1 \nx\n'.encode(), 'é 1\ny\n'.encode()),
+    ('é\r\n\u3000x\r\n'.encode(), 'é\nx\n'.encode()),
+    (b'xxxxxxx\r\nB\r\n', b'xxxxxxx\nB\n'),
+    (b'xxxxxxx\r\nB\r\n', b'xxxxxxx\nC\n'),
+    (b'xxxxxxx\r', b'xxxxxxx\r\n'),
+]
+
+
+def reference(tmp_path, user, expected):
+    (tmp_path / 'user').write_bytes(user)
+    (tmp_path / 'expected').write_bytes(expected)
+    with open(tmp_path / 'user', 'r', encoding='utf-8') as fa, \
+            open(tmp_path / 'expected', 'r', encoding='utf-8') as fb:
+        return tolerant_diff_at(fa, fb)
+
+
+def streamed(tmp_path, user, piece):
+    diff = StreamingDiff(tmp_path / 'expected')
+    for pos in range(0, len(user), piece):
+        diff.write(user[pos:pos + piece])
+    return diff.finish()
+
+
+@pytest.mark.parametrize('user, expected', CASES)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 8, 1024])
+def test_engines_agree(tmp_path, monkeypatch, user, expected, chunk_size):
+    # small chunks put '\r\n' and multi-byte characters across their
+    # boundaries at every offset
+    monkeypatch.setattr(tolerant_diff, 'CHUNK_SIZE', chunk_size)
+    want = reference(tmp_path, user, expected)
+
+    assert _diff_buffers(user, expected) == want
+    assert tolerant_diff_mapped(tmp_path / 'user', tmp_path / 'expected') == want
+    assert streamed(tmp_path, user, chunk_size) == want
+
+
+@pytest.mark.parametrize('tail_user, tail_expected', [
+    (b'\r\nB\r\n', b'\nB\n'),
+    (b'\r\nB\r\n', b'\nC\n'),
+    (b'\rB\r', b'\r\nB'),
+])
+def test_crlf_across_chunk_size(tmp_path, tail_user, tail_expected):
+    # the '\r' is the last byte of the first chunk
+    head = b'0123456\n' * (tolerant_diff.CHUNK_SIZE // 8 - 1) + b'0123456'
+    user, expected = head + tail_user, head + tail_expected
+    want = reference(tmp_path, user, expected)
+
+    assert _diff_buffers(user, expected) == want
+    assert tolerant_diff_mapped(tmp_path / 'user', tmp_path / 'expected') == want
+    assert streamed(tmp_path, user, tolerant_diff.CHUNK_SIZE) == want
@@ -0,0 +1,21 @@
+'''Limits enforced by TimeLimitWatchdog.'''
+
+import subprocess
+
+from iruka.utils.watchdog import TimeLimitWatchdog
+
+
+def test_wall_limit_holds_when_the_jailed_process_is_gone():
+    # no children, and a pid that cannot be read from procfs
+    process = subprocess.Popen(['sleep', '10'])
+    try:
+        watchdog = TimeLimitWatchdog(cpu_limit=10, wall_limit=0)
+        watchdog._jailed_pid = 2 ** 31 - 1
+        watchdog(process)
+        assert watchdog._jailed_pid is None
+        while not watchdog.exceeded:
+            watchdog(process)
+        assert process.wait(timeout=5) != 0
+    finally:
+        process.kill()
+        process.wait()